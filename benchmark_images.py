@@ -0,0 +1,154 @@
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+import requests
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def start_mock_server(server_args):
+    """Run mock_stability_server.py in a child process and return (process, url)"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_stability_server.py")
+    process = subprocess.Popen(
+        [sys.executable, script, "--port", "0", *server_args],
+        stdout=subprocess.PIPE, text=True
+    )
+    # The first line announces the address
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        raise RuntimeError("Mock server failed to start")
+    return process, line.rsplit(" ", 1)[-1].strip()
+
+
+def write_metadata(pipeline, count, metadata_dir, seed):
+    """Generate `count` tokens of metadata files for the chosen pipeline"""
+    if pipeline == "simplified":
+        from simplified_trait_generator import SimplifiedTraitGenerator
+        generator = SimplifiedTraitGenerator(seed=seed)
+    else:
+        from nft_traits import NFTTraitGenerator
+        generator = NFTTraitGenerator(seed=seed)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        generator.save_metadata_stream(generator.iter_traits(1, count), metadata_dir)
+
+
+def run_level(pipeline, concurrency, metadata_dir, output_dir, api_host, coalesce):
+    """Generate every image once at one concurrency level; runs in its own process"""
+    os.environ["STABILITY_API_HOST"] = api_host
+    os.environ.setdefault("STABILITY_API_KEY", "mock")
+    if pipeline == "simplified":
+        from simplified_image_generator import SimplifiedImageGenerator
+        generator = SimplifiedImageGenerator(concurrency=concurrency, use_cache=False, coalesce=coalesce)
+    else:
+        from generate_nft_images import NFTImageGenerator
+        generator = NFTImageGenerator(concurrency=concurrency, use_cache=False, coalesce=coalesce)
+
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = generator.generate_from_metadata_files(metadata_dir, output_dir)
+    seconds = time.perf_counter() - started
+
+    latencies = [result.elapsed for result in results.values() if result.ok and not result.coalesced]
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+    peak_mb = peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+    return {
+        "concurrency": concurrency,
+        "images": sum(1 for result in results.values() if result.ok),
+        "failed": sum(1 for result in results.values() if not result.ok),
+        "seconds": seconds,
+        "images_per_second": len(results) / seconds if seconds else 0.0,
+        "p50": float(np.percentile(latencies, 50)) if latencies else None,
+        "p99": float(np.percentile(latencies, 99)) if latencies else None,
+        "peak_mb": peak_mb,
+    }
+
+
+def format_row(row):
+    def secs(value):
+        return f"{value:8.3f}" if value is not None else "       -"
+    return (
+        f"{row['concurrency']:>11}  {row['images']:>6}  {row['failed']:>6}  {row['seconds']:8.2f}"
+        f"  {row['images_per_second']:8.2f}  {secs(row['p50'])}  {secs(row['p99'])}"
+        f"  {row['peak_mb']:8.1f}  {row['throttled']:>5}  {row['errors']:>5}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the image stage against a local mock of the Stability API"
+    )
+    parser.add_argument("--pipeline", choices=["nft", "simplified"], default="nft")
+    parser.add_argument("--count", type=int, default=200, help="Tokens generated per level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64],
+                        help="Concurrency levels to run")
+    parser.add_argument("--coalesce", action="store_true",
+                        help="Let tokens with identical requests share one call")
+    parser.add_argument("--seed", type=int, default=1, help="Trait seed for the benchmark metadata")
+    parser.add_argument("--json", dest="json_file", default=None, help="Also write the results here")
+    # Passed through to the mock server
+    parser.add_argument("--latency", default="lognormal:0.2,0.3")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    parser.add_argument("--image-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    server_args = [
+        "--latency", args.latency, "--error-rate", str(args.error_rate),
+        "--throttle-rate", str(args.throttle_rate), "--image-size", str(args.image_size),
+        "--seed", str(args.seed),
+    ]
+    if args.retry_after is not None:
+        server_args += ["--retry-after", str(args.retry_after)]
+    if args.max_concurrency is not None:
+        server_args += ["--max-concurrency", str(args.max_concurrency)]
+
+    server, api_host = start_mock_server(server_args)
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="image_benchmark_") as work_dir:
+            metadata_dir = os.path.join(work_dir, "metadata")
+            write_metadata(args.pipeline, args.count, metadata_dir, args.seed)
+            print(f"Benchmarking the {args.pipeline} image stage: {args.count} tokens per level, "
+                  f"mock server at {api_host} (latency {args.latency})")
+            print(f"{'concurrency':>11}  {'images':>6}  {'failed':>6}  {'seconds':>8}  {'images/s':>8}"
+                  f"  {'p50 s':>8}  {'p99 s':>8}  {'peak MB':>8}  {'429s':>5}  {'5xx':>5}")
+
+            for concurrency in args.concurrency:
+                before = requests.get(f"{api_host}/stats").json()
+                # A fresh process per level, so peak memory is measured per level
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    row = pool.submit(
+                        run_level, args.pipeline, concurrency, metadata_dir,
+                        os.path.join(work_dir, f"images_{concurrency}"), api_host, args.coalesce
+                    ).result()
+                after = requests.get(f"{api_host}/stats").json()
+                row["throttled"] = after["throttled"] - before["throttled"]
+                row["errors"] = after["errors"] - before["errors"]
+                rows.append(row)
+                print(format_row(row), flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json_file:
+        with open(args.json_file, "w") as f:
+            json.dump(rows, f, indent=2)
+        print(f"Results saved to {args.json_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+from collections.abc import Mapping, Sequence
+from typing import Callable, Dict, Iterator, List
+
+import numpy as np
+
+
+def _narrow_dtype(high: int):
+    """Smallest unsigned dtype that holds values up to `high`"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if high <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+class TokenView(Mapping):
+    """Lazy metadata record for one token of a Collection.
+
+    Single trait values are read straight from the collection's columns
+    through `trait`. The full OpenSea-style dict is only built the first
+    time a metadata key is accessed, and `to_dict` returns it in the same
+    shape as the JSON files.
+    """
+
+    def __init__(self, collection: "Collection", index: int):
+        self.collection = collection
+        self.index = index
+        self._metadata = None
+
+    @property
+    def token_id(self) -> int:
+        return self.collection.start_id + self.index
+
+    def trait(self, trait_type: str):
+        """Value of a trait column or RPG stat without building the record"""
+        collection = self.collection
+        code = int(collection.codes[trait_type][self.index])
+        if trait_type in collection.vocabularies:
+            return collection.vocabularies[trait_type][code]
+        return code
+
+    def to_dict(self) -> Dict:
+        if self._metadata is None:
+            codes = {name: int(column[self.index]) for name, column in self.collection.codes.items()}
+            self._metadata = self.collection.build(self.token_id, codes)
+        return self._metadata
+
+    def __getitem__(self, key):
+        return self.to_dict()[key]
+
+    def __iter__(self) -> Iterator:
+        return iter(self.to_dict())
+
+    def __len__(self) -> int:
+        return len(self.to_dict())
+
+
+class Collection(Sequence):
+    """Column-wise store of a token range.
+
+    Trait values are kept as small integer codes into shared vocabularies and
+    RPG stats as unsigned integer arrays, one array per column, so a million
+    tokens take a few tens of MB instead of several GB of dicts. Indexing
+    returns a TokenView; the metadata dict is built by the owning
+    generator's `build` callable only when it is read.
+    """
+
+    def __init__(self, start_id: int, codes: Dict[str, np.ndarray],
+                 vocabularies: Dict[str, List[str]],
+                 build: Callable[[int, Dict[str, int]], Dict]):
+        self.start_id = start_id
+        self.vocabularies = vocabularies
+        self.build = build
+        self.codes = {}
+        for name, column in codes.items():
+            column = np.asarray(column)
+            high = len(vocabularies[name]) - 1 if name in vocabularies else int(column.max(initial=0))
+            self.codes[name] = column.astype(_narrow_dtype(high), copy=False)
+        self._count = len(next(iter(codes.values()))) if codes else 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def token_ids(self) -> range:
+        return range(self.start_id, self.start_id + self._count)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("Collection index out of range")
+        return TokenView(self, index)
+
+    def values(self, trait_type: str) -> List:
+        """Decoded values of one trait column or stat for every token"""
+        column = self.codes[trait_type]
+        if trait_type in self.vocabularies:
+            return np.asarray(self.vocabularies[trait_type], dtype=object)[column].tolist()
+        return column.tolist()
@@ -1,7 +1,9 @@
 import json
 import csv
 import os
-import glob
+from metadata_store import PackedMetadataStore
+from metadata_catalog import MetadataCatalog
+from token_layout import TokenLayout
 
 def get_attribute_value(attributes, trait_type):
     """Get value for a specific trait type from attributes list"""
@@ -28,67 +30,110 @@ def get_stat_value(attributes, trait_type):
             return str(attr["value"])
     return ""
 
+# CSV headers
+HEADERS = [
+    "file_name", "name", "description",
+    "attributes[Base]", "attributes[Fur Color]", "attributes[Eyes]",
+    "attributes[Expression]", "attributes[Background]", "attributes[Special Effect]",
+    "attributes[Outfit]", "attributes[Outfit].1", "attributes[Outfit].2",
+    "attributes[Level]", "attributes[Energy]", "attributes[Creativity]",
+    "attributes[Magic Power]", "attributes[Agility]", "attributes[Generation]"
+]
+
+def metadata_to_row(token_id, metadata):
+    """Build the CSV row for one token's metadata"""
+    # Get outfit pieces
+    outfit_pieces = get_outfit_pieces(metadata.get("attributes", []))
+    
+    return {
+        "file_name": f"{token_id}.png",
+        "name": metadata.get("name", ""),
+        "description": metadata.get("description", ""),
+        "attributes[Base]": get_attribute_value(metadata.get("attributes", []), "Base"),
+        "attributes[Fur Color]": get_attribute_value(metadata.get("attributes", []), "Fur Color"),
+        "attributes[Eyes]": get_attribute_value(metadata.get("attributes", []), "Eyes"),
+        "attributes[Expression]": get_attribute_value(metadata.get("attributes", []), "Expression"),
+        "attributes[Background]": get_attribute_value(metadata.get("attributes", []), "Background"),
+        "attributes[Special Effect]": get_attribute_value(metadata.get("attributes", []), "Special Effect"),
+        "attributes[Outfit]": outfit_pieces[0],
+        "attributes[Outfit].1": outfit_pieces[1],
+        "attributes[Outfit].2": outfit_pieces[2],
+        "attributes[Level]": get_stat_value(metadata.get("attributes", []), "Level"),
+        "attributes[Energy]": get_stat_value(metadata.get("attributes", []), "Energy"),
+        "attributes[Creativity]": get_stat_value(metadata.get("attributes", []), "Creativity"),
+        "attributes[Magic Power]": get_stat_value(metadata.get("attributes", []), "Magic Power"),
+        "attributes[Agility]": get_stat_value(metadata.get("attributes", []), "Agility"),
+        "attributes[Generation]": get_stat_value(metadata.get("attributes", []), "Generation")
+    }
+
 def compile_metadata_to_csv(metadata_dir, output_file):
     """Compile all metadata JSON files into a single CSV file"""
-    # Get all JSON files and sort them numerically
-    json_files = glob.glob(os.path.join(metadata_dir, "*.json"))
-    json_files.sort(key=lambda x: int(os.path.basename(x).split('.')[0]))
+    if PackedMetadataStore.is_store(metadata_dir):
+        compile_store_to_csv(metadata_dir, output_file)
+        return
+    if MetadataCatalog.is_catalog(metadata_dir):
+        compile_catalog_to_csv(metadata_dir, output_file)
+        return
     
-    # Prepare CSV headers
-    headers = [
-        "file_name", "name", "description",
-        "attributes[Base]", "attributes[Fur Color]", "attributes[Eyes]",
-        "attributes[Expression]", "attributes[Background]", "attributes[Special Effect]",
-        "attributes[Outfit]", "attributes[Outfit].1", "attributes[Outfit].2",
-        "attributes[Level]", "attributes[Energy]", "attributes[Creativity]",
-        "attributes[Magic Power]", "attributes[Agility]", "attributes[Generation]"
-    ]
+    # List JSON files in token order, from the manifest when fanned out
+    layout = TokenLayout(metadata_dir, ".json")
     
     # Create output directory if it doesn't exist
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
     # Write to CSV
     with open(output_file, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=headers)
+        writer = csv.DictWriter(csvfile, fieldnames=HEADERS)
         writer.writeheader()
         
         # Process each JSON file
-        for json_file in json_files:
-            token_id = os.path.basename(json_file).split('.')[0]
-            
+        for token_id in layout.token_ids():
             # Read JSON metadata
-            with open(json_file, 'r') as f:
+            with open(layout.path(token_id), 'r') as f:
                 metadata = json.load(f)
             
-            # Get outfit pieces
-            outfit_pieces = get_outfit_pieces(metadata.get("attributes", []))
-            
-            # Create row data
-            row = {
-                "file_name": f"{token_id}.png",
-                "name": metadata.get("name", ""),
-                "description": metadata.get("description", ""),
-                "attributes[Base]": get_attribute_value(metadata.get("attributes", []), "Base"),
-                "attributes[Fur Color]": get_attribute_value(metadata.get("attributes", []), "Fur Color"),
-                "attributes[Eyes]": get_attribute_value(metadata.get("attributes", []), "Eyes"),
-                "attributes[Expression]": get_attribute_value(metadata.get("attributes", []), "Expression"),
-                "attributes[Background]": get_attribute_value(metadata.get("attributes", []), "Background"),
-                "attributes[Special Effect]": get_attribute_value(metadata.get("attributes", []), "Special Effect"),
-                "attributes[Outfit]": outfit_pieces[0],
-                "attributes[Outfit].1": outfit_pieces[1],
-                "attributes[Outfit].2": outfit_pieces[2],
-                "attributes[Level]": get_stat_value(metadata.get("attributes", []), "Level"),
-                "attributes[Energy]": get_stat_value(metadata.get("attributes", []), "Energy"),
-                "attributes[Creativity]": get_stat_value(metadata.get("attributes", []), "Creativity"),
-                "attributes[Magic Power]": get_stat_value(metadata.get("attributes", []), "Magic Power"),
-                "attributes[Agility]": get_stat_value(metadata.get("attributes", []), "Agility"),
-                "attributes[Generation]": get_stat_value(metadata.get("attributes", []), "Generation")
-            }
-            
             # Write row to CSV
-            writer.writerow(row)
+            writer.writerow(metadata_to_row(token_id, metadata))
             print(f"Processed metadata for token #{token_id}")
 
+def compile_store_to_csv(store_path, output_file):
+    """Compile a packed metadata store into a single CSV file"""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    
+    with open(output_file, 'w', newline='') as csvfile, PackedMetadataStore(store_path) as store:
+        writer = csv.DictWriter(csvfile, fieldnames=HEADERS)
+        writer.writeheader()
+        
+        for token_id, metadata in store:
+            writer.writerow(metadata_to_row(token_id, metadata))
+        print(f"Processed metadata for {len(store)} tokens")
+
+def compile_catalog_to_csv(catalog_path, output_file, traits=None, where=None, params=()):
+    """Compile the tokens a metadata catalog query selects into a single CSV file"""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    
+    with open(output_file, 'w', newline='') as csvfile, MetadataCatalog(catalog_path) as catalog:
+        writer = csv.DictWriter(csvfile, fieldnames=HEADERS)
+        writer.writeheader()
+        
+        rows = 0
+        for token_id, metadata in catalog.select(traits, where, params):
+            writer.writerow(metadata_to_row(token_id, metadata))
+            rows += 1
+        print(f"Processed metadata for {rows} tokens")
+
+def compile_collection_to_csv(collection, output_file):
+    """Compile a Collection into a single CSV file without reading metadata files"""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=HEADERS)
+        writer.writeheader()
+        
+        for view in collection:
+            writer.writerow(metadata_to_row(view.token_id, view.to_dict()))
+        print(f"Processed metadata for {len(collection)} tokens")
+
 def main():
     metadata_dir = "metadata"
     output_file = "metadata_csv/compiled_metadata.csv"
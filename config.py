@@ -144,6 +144,36 @@ COMMON_TRAITS = {
     ]
 }
 
+# Rarity tiers as a percentage of tokens per trait value. Values that are not
+# listed share the remaining percentage evenly; "Base" refers to the keys of
+# CHARACTER_TYPES
+TRAIT_RARITY = {
+    "Base": {
+        "Cat": 0.5
+    },
+    "Special Effect": {
+        "Lightning": 2
+    }
+}
+
+# Exact joint targets used by quota allocation, as a percentage of tokens
+# per value pair, e.g. {("Base", "Background"): {("Pirate", "Beach"): 5}}.
+# A listed pair gets exactly that many tokens and is then left out of the
+# free allocation; pairs that are not listed are drawn freely from the
+# remaining per-value quotas
+JOINT_QUOTAS = {}
+
+# Compatibility rules between trait values. Each rule has an "if" condition on
+# one trait and any of:
+#   "forbid":  values of other traits that can never appear with it
+#   "require": the only values of other traits allowed with it
+#   "omit":    traits the character does not get (their value becomes "None")
+TRAIT_RULES = [
+    {"if": {"Base": ["Frog", "Cat"]}, "omit": ["Hair Color"]},
+    {"if": {"Special Effect": ["Fire"]}, "forbid": {"Background": ["River", "Beach"]}},
+    {"if": {"Base": ["Princess"]}, "require": {"Background": ["Castle", "Village"]}}
+]
+
 # RPG Stats for characters
 RPG_STATS = {
     "Level": (1, 99),
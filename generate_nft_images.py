@@ -1,13 +1,46 @@
+import asyncio
 import json
 import os
-from generate_pfp import PFPGenerator
-import glob
+from typing import Dict, Iterable, List, Tuple
+from generate_pfp import PFPGenerator, format_call_report
+from image_cache import DEFAULT_CACHE_DIR
+from layer_renderer import LayerRenderer, DEFAULT_LAYERS_DIR
+from metadata_store import PackedMetadataStore
+from metadata_catalog import MetadataCatalog
+from token_layout import TokenLayout
 
 class NFTImageGenerator:
-    def __init__(self):
-        self.generator = PFPGenerator()
+    def __init__(self, fanout: int = None, concurrency: int = 1, rate_limit: float = None,
+                 use_cache: bool = True, coalesce: bool = True, variants: int = 1,
+                 backend: str = "api", layers_dir: str = DEFAULT_LAYERS_DIR,
+                 render_workers: int = None, layer_scale: int = 1):
+        if backend not in ("api", "layers"):
+            raise ValueError(f"Unknown image backend {backend!r}")
+        # backend="api" generates each image with the Stability API; rate_limit
+        # caps requests per second (see RateLimiter), and with use_cache
+        # repeated requests are served from the image cache
+        self.generator = PFPGenerator(
+            rate_limit=rate_limit, cache_dir=DEFAULT_CACHE_DIR if use_cache else None
+        ) if backend == "api" else None
+        # backend="layers" composites local per-trait PNG layers instead
+        # (see LayerRenderer), in render_workers processes
+        self.renderer = LayerRenderer(layers_dir, scale=layer_scale) if backend == "layers" else None
+        self.render_workers = render_workers
+        # Number of image requests kept in flight by generate_images
+        self.concurrency = concurrency
+        # Tokens whose requests are identical share one API call
+        self.coalesce = coalesce
+        # Candidate images requested per token in a single call; each is kept
+        # as <token_id>_<i>.png with its seed in <token_id>.variants.json
+        self.variants = variants
+        # Directory fanout of the image trees written (see TokenLayout)
+        self.fanout = fanout
+        self.layouts = {}
         self.base_prompt = """16x16 pixel art, tiny sprite of a chibi girl chef, wearing a white apron and a big chef hat, standing in a small kitchen with stove and utensils, NES-style, limited color palette, blocky pixels, minimal detail, retro video game sprite, centered composition, low resolution, clear silhouette, cute and simple
 no background, transparent background, character only"""
+        self.negative_prompt = """realistic, detailed, professional, clean lines, proper anatomy,
+            correct proportions, sophisticated, mature style, complex shading, perfect symmetry,
+            photorealistic, refined artwork, advanced technique, adult art style, dog, human"""
 
 
     def traits_to_prompt(self, traits):
@@ -198,44 +231,134 @@ no background, transparent background, character only"""
         return prompt
 
     def generate_from_metadata_files(self, metadata_dir: str, output_dir: str):
-        """Generate images from individual metadata JSON files"""
+        """Generate images from individual metadata JSON files, a packed store or a catalog"""
         os.makedirs(output_dir, exist_ok=True)
         
-        # Get all metadata files and sort them by number
-        metadata_files = glob.glob(os.path.join(metadata_dir, "*.json"))
-        metadata_files.sort(key=lambda x: int(os.path.basename(x).split('.')[0]))
+        if PackedMetadataStore.is_store(metadata_dir):
+            with PackedMetadataStore(metadata_dir) as store:
+                return self.generate_images(
+                    ((token_id, nft["attributes"]) for token_id, nft in store), output_dir
+                )
+        if MetadataCatalog.is_catalog(metadata_dir):
+            return self.generate_from_catalog(metadata_dir, output_dir)
         
-        # Process each metadata file
-        for metadata_file in metadata_files:
-            # Get token ID from filename (e.g., "1.json" -> "1")
-            token_id = os.path.basename(metadata_file).split('.')[0]
-            output_path = os.path.join(output_dir, f"{token_id}.png")
-            
-            print(f"\nProcessing NFT #{token_id}...")
-            
-            # Load metadata from file
-            with open(metadata_file, 'r') as f:
-                nft = json.load(f)
-            
-            print(f"Character: {next(t['value'] for t in nft['attributes'] if t['trait_type'] == 'Base')}")
-            
-            # Convert traits to prompt
-            prompt = self.traits_to_prompt(nft["attributes"])
-            
-            # Generate image
-            self.generator.generate_image(
-                prompt=prompt,
-                negative_prompt="""realistic, detailed, professional, clean lines, proper anatomy,
-                correct proportions, sophisticated, mature style, complex shading, perfect symmetry,
-                photorealistic, refined artwork, advanced technique, adult art style, dog, human""",
-                seed=int(token_id)  # Use token_id as seed for reproducibility
+        # List metadata files in token order, from the manifest when fanned out
+        layout = TokenLayout(metadata_dir, ".json")
+        
+        def tokens():
+            # Process each metadata file
+            for token_id in layout.token_ids():
+                # Load metadata from file
+                with open(layout.path(token_id), 'r') as f:
+                    nft = json.load(f)
+                yield token_id, nft["attributes"]
+        
+        return self.generate_images(tokens(), output_dir)
+
+    def generate_from_catalog(self, catalog_path: str, output_dir: str, traits: Dict = None,
+                              where: str = None, params=()):
+        """Generate images for the tokens a metadata catalog query selects"""
+        os.makedirs(output_dir, exist_ok=True)
+        
+        with MetadataCatalog(catalog_path) as catalog:
+            return self.generate_images(
+                ((token_id, nft["attributes"]) for token_id, nft in catalog.select(traits, where, params)),
+                output_dir
             )
+
+    def generate_from_collection(self, collection, output_dir: str):
+        """Generate images straight from a Collection, without metadata files"""
+        os.makedirs(output_dir, exist_ok=True)
+        
+        return self.generate_images(
+            ((view.token_id, view["attributes"]) for view in collection), output_dir
+        )
+
+    def generate_images(self, tokens: Iterable[Tuple[int, List]], output_dir: str):
+        """Generate images for (token_id, attributes) pairs.
+        
+        With concurrency > 1 up to that many API requests run at once and
+        each image is written to its token path as soon as it arrives.
+        With coalescing on, tokens whose requests are identical share one
+        API call and the image is linked to each of them. Otherwise tokens
+        are generated one at a time. Returns token_id -> GenerationResult,
+        so callers can see which tokens failed and why. With the layers
+        backend tokens are rendered locally in a process pool instead.
+        """
+        if self.renderer is not None:
+            layout = self.image_layout(output_dir)
             
-            # Rename the generated file to match token_id
-            latest_file = max(glob.glob(os.path.join("output", "*.png")), key=os.path.getctime)
-            os.rename(latest_file, output_path)
+            def rendered(token_id, result):
+                if result.ok:
+                    layout.record([token_id])
+                else:
+                    print(f"Failed to render image for NFT #{token_id}: {result.error}")
             
-            print(f"Generated image saved as {output_path}")
+            return self.renderer.render_tokens(tokens, layout, self.render_workers, on_result=rendered)
+        
+        if self.concurrency <= 1 and not self.coalesce:
+            results = {}
+            for token_id, attributes in tokens:
+                results[token_id] = self.generate_token_image(token_id, attributes, output_dir)
+            return results
+        
+        layout = self.image_layout(output_dir)
+        jobs = (
+            (token_id, self.traits_to_prompt(attributes), self.negative_prompt, token_id)
+            for token_id, attributes in tokens
+        )
+        
+        def saved(token_id, result):
+            if result.ok:
+                layout.record([token_id])
+                print(f"Generated image saved as {result.path}")
+            else:
+                print(f"Failed to generate image for NFT #{token_id}: {result.status} ({result.error})")
+        
+        results = asyncio.run(self.generator.generate_images_async(
+            jobs, max(1, self.concurrency), output_path=layout.output_path, on_result=saved,
+            stats_interval=30, coalesce=self.coalesce, samples=self.variants
+        ))
+        print(format_call_report(results))
+        return results
+
+    def image_layout(self, output_dir: str) -> TokenLayout:
+        """Layout of the per-token images under output_dir"""
+        if output_dir not in self.layouts:
+            layout = TokenLayout(output_dir, ".png", self.fanout)
+            layout.prepare()
+            self.layouts[output_dir] = layout
+        return self.layouts[output_dir]
+
+    def generate_token_image(self, token_id: int, attributes, output_dir: str):
+        """Generate the image for one token from its attributes with the API, returning its GenerationResult.
+        The layers backend renders in batches in generate_images instead.
+        """
+        layout = self.image_layout(output_dir)
+        output_path = layout.output_path(token_id)
+        
+        print(f"\nProcessing NFT #{token_id}...")
+        print(f"Character: {next(t['value'] for t in attributes if t['trait_type'] == 'Base')}")
+        
+        # Convert traits to prompt
+        prompt = self.traits_to_prompt(attributes)
+        
+        # Generate the image straight into its token path
+        self.generator.generate_image(
+            prompt=prompt,
+            negative_prompt=self.negative_prompt,
+            seed=token_id,  # Use token_id as seed for reproducibility
+            output_file=output_path,
+            samples=self.variants
+        )
+        result = self.generator.last_result
+        if not result.ok:
+            print(f"Failed to generate image for NFT #{token_id}: {result.status} ({result.error})")
+            return result
+        layout.record([token_id])
+        
+        print(f"Generated image saved as {output_path}")
+        return result
 
 def main():
     generator = NFTImageGenerator()
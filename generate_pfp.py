@@ -1,51 +1,248 @@
 import os
+import asyncio
+import json
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from dotenv import load_dotenv
 from pathlib import Path
 from datetime import datetime
+from typing import NamedTuple, Optional, Tuple
+from rate_limiter import (
+    RateLimiter, parse_retry_after, OUTCOME_OK, OUTCOME_THROTTLED, OUTCOME_ERROR
+)
+from image_cache import (
+    ImageCache, request_key, link_or_copy, clone_or_copy, atomic_output, write_atomic, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+)
 import base64
-import json
 import random
 
 # Load environment variables
 load_dotenv()
 
+# Outcome of an image request
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"  # Permanent error (bad request, auth, malformed response)
+STATUS_RETRIES_EXHAUSTED = "retries_exhausted"  # Transient errors on every attempt
+
+# HTTP statuses worth retrying: rate limiting and server-side failures
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Statuses that tell the rate limiter to back off
+THROTTLE_STATUS_CODES = {429, 503}
+
+# Errors worth retrying: the connection failed, timed out or broke mid-body
+TRANSIENT_ERRORS = (
+    requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError
+)
+
+# Bytes of the response body read at a time when streaming an image to disk
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class GenerationResult(NamedTuple):
+    """Status of one image request, with the image data or written path on success"""
+    status: str
+    attempts: int
+    image: Optional[bytes] = None
+    path: Optional[str] = None
+    error: Optional[str] = None
+    cached: bool = False
+    coalesced: bool = False  # Shared from an identical request made in the same run
+    elapsed: Optional[float] = None  # Seconds from the cache lookup until the image was saved
+    variants: Optional[Tuple[Tuple[str, Optional[int]], ...]] = None  # (path, seed) per sample
+
+    @property
+    def ok(self):
+        return self.status == STATUS_OK
+
+
+def failed_tokens(results):
+    """Group the token ids of unsuccessful results by status"""
+    failed = {}
+    for token_id, result in sorted(results.items()):
+        if not result.ok:
+            failed.setdefault(result.status, []).append(token_id)
+    return failed
+
+
+def format_call_report(results):
+    """One line on how many images needed an API request and how many calls were saved"""
+    cached = sum(1 for result in results.values() if result.ok and result.cached and not result.coalesced)
+    coalesced = sum(1 for result in results.values() if result.ok and result.coalesced)
+    # Jobs that shared a failed request got no image, so they saved nothing
+    shared_failures = sum(1 for result in results.values() if result.coalesced and not result.ok)
+    requested = len(results) - cached - coalesced - shared_failures
+    return (
+        f"{len(results)} images: {requested} requested from the API, {cached} from the image cache, "
+        f"{coalesced} shared with an identical request ({cached + coalesced} API calls saved)"
+        f"{f', {shared_failures} failed with the request they shared' if shared_failures else ''}"
+    )
+
+
+def decode_artifact_stream(chunks, open_output):
+    """
+    Decode the `artifacts[].base64` fields of a streamed JSON body.
+    
+    The body arrives as an iterable of byte chunks and is never held whole:
+    artifact number i is decoded into the file open_output(i) returns (or
+    skipped if it returns None), and between chunks only a possible partial
+    field name or the last partial base64 quantum (under 4 characters) is
+    carried over, so memory stays bounded by the chunk size. The rest of
+    the body is small and is kept, so per-artifact fields like the seed
+    can still be read.
+    
+    Returns:
+        dict: The parsed response, with every base64 value emptied
+        
+    Raises:
+        ValueError: If the body has no image, is cut short or the base64 is invalid
+    """
+    marker = b'"base64"'
+    skeleton = bytearray()
+    carry = b""
+    state = "seek"  # seek -> open (the name was found) -> value -> seek
+    index = -1
+    output = None
+    for chunk in chunks:
+        data = carry + chunk
+        carry = b""
+        while data:
+            if state == "seek":
+                start = data.find(marker)
+                if start < 0:
+                    # Keep enough to match a name split across chunks
+                    keep = len(marker) - 1
+                    skeleton += data[:-keep]
+                    carry = data[-keep:]
+                    break
+                skeleton += data[:start + len(marker)]
+                data = data[start + len(marker):]
+                state = "open"
+            elif state == "open":
+                value_start = data.lstrip(b" \t\r\n:")
+                skeleton += data[:len(data) - len(value_start)]
+                data = value_start
+                if not data:
+                    break
+                if data[:1] != b'"':
+                    raise ValueError("artifact base64 field is not a string")
+                skeleton += b'"'
+                data = data[1:]
+                index += 1
+                output = open_output(index)
+                state = "value"
+            else:
+                end = data.find(b'"')
+                # JSON may escape "/" as "\/"; base64 has no other escapes
+                value = (data if end < 0 else data[:end]).replace(b"\\", b"")
+                if end < 0:
+                    usable = len(value) - len(value) % 4
+                    carry = value[usable:]
+                    value = value[:usable]
+                image = base64.b64decode(value, validate=True)
+                if output is not None:
+                    output.write(image)
+                if end < 0:
+                    break
+                # The closing quote goes back into the skeleton
+                data = data[end:]
+                state = "seek"
+    if index < 0:
+        raise ValueError("No image data found in response")
+    if state != "seek":
+        raise ValueError("Response ended inside an artifact")
+    return json.loads(bytes(skeleton + carry))
+
+
+def variant_paths(output_file, samples):
+    """Deterministic paths for the samples of one request: <name>_<i><ext> beside output_file"""
+    root, ext = os.path.splitext(str(output_file))
+    return [f"{root}_{i}{ext}" for i in range(samples)]
+
+
+def variants_file(output_file):
+    """Sidecar recording the file, seed and finish reason of each variant"""
+    return f"{os.path.splitext(str(output_file))[0]}.variants.json"
+
+
+def coalescing_key(url, payload, seed):
+    """Key under which identical requests in one run share a single API call.
+    
+    Jobs without a seed leave it to the generator, so they match on
+    everything but the seed and share the seed the first one draws.
+    """
+    return request_key(url, payload if seed is not None else dict(payload, seed=None))
+
+
 class PFPGenerator:
-    def __init__(self):
+    def __init__(self, pool_size=16, connect_timeout=10, read_timeout=180,
+                 max_retries=4, backoff=2.0, backoff_max=60.0,
+                 rate_limit=None, max_concurrency=None, max_throttled_retries=30,
+                 cache_dir=DEFAULT_CACHE_DIR, cache_max_bytes=DEFAULT_MAX_BYTES):
         self.api_key = os.getenv('STABILITY_API_KEY')
         if not self.api_key:
             raise ValueError("Please set STABILITY_API_KEY in your .env file")
         
-        self.base_url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
+        # STABILITY_API_HOST points the generator at another server, such as
+        # mock_stability_server.py
+        api_host = os.getenv('STABILITY_API_HOST', "https://api.stability.ai").rstrip("/")
+        self.base_url = f"{api_host}/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Accept": "application/json",
             "Content-Type": "application/json"
         }
         
-        # Create directories if they don't exist
+        # One keep-alive session for every request, so connections are reused
+        # instead of paying a TCP+TLS handshake per image
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.pool_size = 0
+        self.resize_pool(pool_size)
+        # Jitter has its own generator so retries never shift the seed sequence
+        self._jitter = random.Random()
+        
+        # Every request, from any thread, passes through one rate limiter.
+        # 429s have their own retry budget so throttling does not drop jobs
+        self.limiter = RateLimiter(rate=rate_limit, max_concurrency=max_concurrency)
+        self.max_throttled_retries = max_throttled_retries
+        self.last_result = None
+        
+        # Identical requests (same payload and model URL) are served from the
+        # on-disk image cache; cache_dir=None disables it
+        self.cache = ImageCache(cache_dir, cache_max_bytes) if cache_dir else None
+        
+        # Default destination for images generated without a target path;
+        # created on first use
         self.output_dir = Path('output')
-        self.output_dir.mkdir(exist_ok=True)
 
-    def generate_image(self, prompt="", negative_prompt="", seed=None):
-        """
-        Generate an image using the Stability API with text-to-image.
-        
-        Args:
-            prompt (str): Text prompt describing the desired output
-            negative_prompt (str): Things to avoid in the generation
-            seed (int): Random seed for reproducibility
-            
-        Returns:
-            str: Path to the generated image file, or None if generation failed
-        """
-        payload = {
+    def resize_pool(self, pool_size):
+        """Keep up to pool_size connections open to the API host"""
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.pool_size = pool_size
+
+    def backoff_delay(self, attempt):
+        """Exponential backoff with full jitter before retry number `attempt` (1-based)"""
+        return self._jitter.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1)))
+
+    def build_payload(self, prompt="", negative_prompt="", seed=None, samples=1):
+        """Build the text-to-image request body, asking for `samples` images"""
+        return {
             "steps": 50,
             "width": 1024,
             "height": 1024,
             "seed": seed if seed is not None else random.randint(0, 4294967295),
             "cfg_scale": 7.5,
-            "samples": 1,
+            "samples": samples,
             "text_prompts": [
                 {
                     "text": prompt,
@@ -59,45 +256,338 @@ class PFPGenerator:
             "style_preset": "pixel-art"  # Corrected to pixel-art (with hyphen) for better results
         }
 
-        try:
-            # Make the API request
-            response = requests.post(
-                self.base_url,
-                headers=self.headers,
-                json=payload
-            )
+    def request_image(self, prompt="", negative_prompt="", seed=None):
+        """
+        Request one image from the Stability API.
+        
+        Each attempt waits for the rate limiter first. Connection errors,
+        timeouts and 5xx responses are retried up to max_retries times with
+        jittered exponential backoff, and 429 responses up to
+        max_throttled_retries times; a Retry-After header replaces the
+        backoff delay. Other errors fail straight away.
+        
+        Returns:
+            GenerationResult: status and attempt count, with the decoded PNG
+            data in `image` on success
+        """
+        return self.send_payload(self.build_payload(prompt, negative_prompt, seed))
+
+    def send_payload(self, payload, output_file=None):
+        """
+        POST a built payload with rate limiting and retries (see request_image).
+        
+        With output_file the response body is streamed and the image decoded
+        chunk by chunk straight into that file (written under a temporary
+        name and renamed into place), so the result carries `path` instead
+        of the image data and the response is never held in memory. A
+        multi-sample payload saves every sample (see read_image).
+        """
+        # Retries resend the same payload, including the seed
+        error = None
+        attempt = failures = throttled = 0
+
+        while True:
+            attempt += 1
+            self.limiter.acquire()
+            outcome, retry_after, result, response = OUTCOME_ERROR, None, None, None
+            try:
+                # Make the API request; the body is read only once the status is known
+                response = self.session.post(
+                    self.base_url, json=payload, timeout=self.timeout, stream=True
+                )
+                if response.status_code == 200:
+                    # Read inside the limiter slot, so downloads count as in flight
+                    result = self.read_image(response, attempt, output_file, payload["samples"])
+                    outcome = OUTCOME_OK if result.ok else OUTCOME_ERROR
+                elif response.status_code in THROTTLE_STATUS_CODES:
+                    outcome = OUTCOME_THROTTLED
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            except TRANSIENT_ERRORS as e:
+                response = None
+                error = f"{type(e).__name__}: {e}"
+                print(f"Request failed (attempt {attempt}): {error}")
+            except requests.RequestException as e:
+                print(f"Error processing request: {e}")
+                result = GenerationResult(STATUS_FAILED, attempt, error=str(e))
+            finally:
+                # Whatever happened, the slot goes back to the limiter
+                self.limiter.release(outcome, retry_after)
+            
+            if result is not None:
+                return result
+
+            # Retry transient failures
+            if response is None or response.status_code in TRANSIENT_STATUS_CODES:
+                if response is not None:
+                    # Hand the connection back to the pool unread
+                    response.close()
+                    error = f"HTTP {response.status_code}"
+                    print(f"Error: {response.status_code} (attempt {attempt})")
+                if response is not None and response.status_code == 429:
+                    throttled += 1
+                    if throttled > self.max_throttled_retries:
+                        break
+                    retries = throttled
+                else:
+                    failures += 1
+                    if failures > self.max_retries:
+                        break
+                    retries = failures
+                time.sleep(retry_after if retry_after is not None else self.backoff_delay(retries))
+                continue
 
             # Handle the response
-            if response.status_code == 200:
+            print(f"Error: {response.status_code}")
+            print(f"Response: {response.text}")
+            return GenerationResult(STATUS_FAILED, attempt, error=f"HTTP {response.status_code}")
+
+        return GenerationResult(STATUS_RETRIES_EXHAUSTED, attempt, error=error)
+
+    def read_image(self, response, attempt, output_file=None, samples=1):
+        """
+        Decode the images from a 200 response, into output_file when given.
+        
+        With samples > 1 each artifact is saved at its variant path (see
+        `variant_paths`), the first one is also linked at output_file as the
+        default pick, and the seeds are recorded in the `variants_file`.
+        """
+        try:
+            if output_file is None:
                 response_json = response.json()
-                if 'artifacts' in response_json and len(response_json['artifacts']) > 0:
-                    # Get the base64 image data
-                    image_data = response_json['artifacts'][0]['base64']
-                    image_bytes = base64.b64decode(image_data)
-                    
-                    # Generate output filename with timestamp
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    output_file = self.output_dir / f"generated_pfp_{timestamp}.png"
-                    
-                    # Save the generated image
-                    with open(output_file, "wb") as f:
-                        f.write(image_bytes)
-                    print(f"Image successfully generated and saved as {output_file}")
-                    
-                    # Return the path to the generated image
-                    return str(output_file)
-                else:
-                    print("No image data found in response")
-                    print(f"Response content: {json.dumps(response_json, indent=2)}")
-                    return None
-            else:
-                print(f"Error: {response.status_code}")
-                print(f"Response: {response.text}")
-                return None
+                # Get the base64 image data
+                image_data = response_json['artifacts'][0]['base64']
+                return GenerationResult(STATUS_OK, attempt, image=base64.b64decode(image_data))
+            
+            files = variant_paths(output_file, samples) if samples > 1 else [str(output_file)]
+            with ExitStack() as outputs:
+                def open_output(index):
+                    if index >= len(files):
+                        return None
+                    return outputs.enter_context(atomic_output(files[index]))
+                body = decode_artifact_stream(response.iter_content(STREAM_CHUNK_SIZE), open_output)
+            if samples == 1:
+                return GenerationResult(STATUS_OK, attempt, path=str(output_file))
+            
+            artifacts = body["artifacts"][:len(files)]
+            variants = tuple((files[i], artifact.get("seed")) for i, artifact in enumerate(artifacts))
+            link_or_copy(files[0], str(output_file))
+            record = [
+                {"file": os.path.basename(path), "seed": seed, "finish_reason": artifact.get("finishReason")}
+                for (path, seed), artifact in zip(variants, artifacts)
+            ]
+            write_atomic(variants_file(output_file), json.dumps({"variants": record}, indent=2).encode())
+            return GenerationResult(STATUS_OK, attempt, path=str(output_file), variants=variants)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print("No image data found in response")
+            if output_file is None:
+                print(f"Response content: {response.text[:1000]}")
+            return GenerationResult(STATUS_FAILED, attempt, error=f"Malformed response: {e}")
+        except requests.RequestException:
+            # Broken downloads are the caller's to retry, though they are OSErrors too
+            raise
+        except OSError as e:
+            # The image arrived but could not be written (disk full, no permission, ...)
+            print(f"Could not save image to {output_file}: {e}")
+            return GenerationResult(STATUS_FAILED, attempt, error=f"Could not save image: {e}")
+        finally:
+            response.close()
 
-        except Exception as e:
-            print(f"Error processing request: {e}")
+    def generate_image(self, prompt="", negative_prompt="", seed=None, output_file=None, samples=1):
+        """
+        Generate an image using the Stability API with text-to-image.
+        
+        Args:
+            prompt (str): Text prompt describing the desired output
+            negative_prompt (str): Things to avoid in the generation
+            seed (int): Random seed for reproducibility
+            output_file (str): Where to save the image. It is written under a
+                temporary name beside it and renamed into place; defaults to
+                a timestamped file in output/
+            samples (int): Number of variants to request in the one call;
+                above 1 each is saved as <name>_<i>.png with its seed
+                recorded in <name>.variants.json, and the first is also
+                saved as output_file
+            
+        Returns:
+            str: Path to the generated image file, or None if generation failed.
+            The full GenerationResult is kept in `last_result`.
+        """
+        if output_file is None:
+            output_file = self.default_output_file()
+        
+        result = self.generate_image_to(output_file, prompt, negative_prompt, seed, samples)
+        self.last_result = result
+        if not result.ok:
             return None
+        print(f"Image successfully {'loaded from cache' if result.cached else 'generated'} "
+              f"and saved as {output_file}")
+        
+        # Return the path to the generated image
+        return result.path
+
+    def default_output_file(self):
+        """Timestamped path in output/, unique to the microsecond"""
+        self.output_dir.mkdir(exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        return self.output_dir / f"generated_pfp_{timestamp}.png"
+
+    def generate_image_to(self, output_file, prompt="", negative_prompt="", seed=None, samples=1):
+        """Generate an image and save it straight to output_file, returning its GenerationResult"""
+        return self.generate_payload_to(
+            output_file, self.build_payload(prompt, negative_prompt, seed, samples)
+        )
+
+    def generate_payload_to(self, output_file, payload):
+        """Request a built payload and save the image straight to output_file.
+        
+        A request already in the image cache is copied (reflinked where
+        supported) from there without calling the API. The file is written under a temporary name and
+        renamed into place. Multi-sample requests bypass the cache, which
+        holds one image per request.
+        """
+        started = time.monotonic()
+        use_cache = self.cache is not None and payload["samples"] == 1
+        key = request_key(self.base_url, payload) if use_cache else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                # A copy, not a link, so rewriting the output cannot reach the cache
+                clone_or_copy(cached, str(output_file))
+                return GenerationResult(STATUS_OK, 0, path=str(output_file), cached=True,
+                                        elapsed=time.monotonic() - started)
+        
+        result = self.send_payload(payload, output_file)
+        if result.ok and key is not None:
+            self.cache.put_file(key, result.path)
+        return result._replace(elapsed=time.monotonic() - started)
+
+    async def generate_images_async(self, jobs, concurrency=4, output_path=None, on_result=None,
+                                    stats_interval=None, coalesce=True, samples=1):
+        """
+        Generate many images with up to `concurrency` requests in flight.
+        
+        Args:
+            jobs: Iterable of (token_id, prompt, negative_prompt, seed) tuples,
+                consumed lazily so it can be a generator over a large drop
+            concurrency (int): Maximum number of requests in flight
+            output_path: Callable mapping a token_id to the file to write;
+                defaults to output/token_<token_id>.png
+            on_result: Optional callback(token_id, result) run on the event
+                loop as each request finishes
+            stats_interval (float): If set, print the rate limiter's stats
+                every this many seconds
+            coalesce (bool): Send one request per distinct payload (see
+                `coalescing_key`); every other job with the same payload waits
+                for it and gets its image as a link, with `coalesced` set.
+                Only single-sample requests are coalesced
+            samples (int): Variants requested per job in one call (see
+                generate_image)
+            
+        Returns:
+            dict: token_id -> GenerationResult
+        """
+        if output_path is None:
+            self.output_dir.mkdir(exist_ok=True)
+            output_path = lambda token_id: str(self.output_dir / f"token_{token_id}.png")
+        if concurrency > self.pool_size:
+            self.resize_pool(concurrency)
+        # The rate limiter's adaptive limit works within the worker count
+        self.limiter.set_budget(concurrency)
+        
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(concurrency)
+        results = {}
+        pending = set()
+        errors = []
+        # Coalescing key -> future of the first result for that payload
+        shared = {}
+        
+        # Blocking requests run in worker threads; each result is written by
+        # its thread as soon as it arrives
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            def failure(token_id, e):
+                error = f"{type(e).__name__}: {e}"
+                print(f"Error generating image for token {token_id}: {error}")
+                return GenerationResult(STATUS_FAILED, 0, error=error)
+            
+            async def request(token_id, prompt, negative_prompt, seed):
+                holding_slot = True
+                try:
+                    output_file = output_path(token_id)
+                    payload = self.build_payload(prompt, negative_prompt, seed, samples)
+                    key = coalescing_key(self.base_url, payload, seed) if coalesce and samples == 1 else None
+                    if key in shared:
+                        # Waiting on another job's request needs no request slot
+                        slots.release()
+                        holding_slot = False
+                        return self.share_result(await shared[key], output_file)
+                    
+                    first = None
+                    if key is not None:
+                        first = shared[key] = loop.create_future()
+                    try:
+                        result = await loop.run_in_executor(
+                            pool, self.generate_payload_to, output_file, payload
+                        )
+                    except Exception as e:
+                        # Jobs sharing this request get the failure, not the exception
+                        result = failure(token_id, e)
+                    except BaseException as e:
+                        if first is not None:
+                            first.set_exception(e)
+                        raise
+                    if first is not None:
+                        first.set_result(result)
+                    return result
+                finally:
+                    if holding_slot:
+                        slots.release()
+            
+            async def run(token_id, *job):
+                try:
+                    result = await request(token_id, *job)
+                except Exception as e:
+                    # Every token gets a result, so none goes missing from the report
+                    result = failure(token_id, e)
+                results[token_id] = result
+                if on_result is not None:
+                    on_result(token_id, result)
+            
+            def finished(task):
+                pending.discard(task)
+                if not task.cancelled() and task.exception() is not None:
+                    errors.append(task.exception())
+            
+            async def report():
+                while True:
+                    await asyncio.sleep(stats_interval)
+                    print(f"[rate] {self.limiter.format_stats()}")
+            
+            reporter = asyncio.create_task(report()) if stats_interval else None
+            try:
+                for job in jobs:
+                    # Only pull the next job once a request slot is free
+                    await slots.acquire()
+                    task = asyncio.create_task(run(*job))
+                    pending.add(task)
+                    task.add_done_callback(finished)
+                if pending:
+                    await asyncio.gather(*pending)
+                if errors:
+                    # Only on_result can fail here; its error is raised, not dropped
+                    raise errors[0]
+            finally:
+                if reporter is not None:
+                    reporter.cancel()
+        
+        return results
+
+    def share_result(self, result, output_file):
+        """Give another token the outcome of an identical request, linking its image"""
+        if not result.ok:
+            return result._replace(coalesced=True)
+        link_or_copy(result.path, str(output_file))
+        return result._replace(attempts=0, path=str(output_file), coalesced=True)
 
 
 def main():
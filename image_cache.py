@@ -0,0 +1,275 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_CACHE_DIR = "image_cache"
+DEFAULT_MAX_BYTES = 5 * 1024 ** 3
+INDEX_FILE = "index.sqlite3"
+
+# Linux ioctl that clones a file's extents copy-on-write (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def request_key(url: str, payload: Dict) -> str:
+    """Hash of everything that determines the generated image"""
+    canonical = json.dumps({"url": url, "payload": payload}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def atomic_output(path: str):
+    """Open a temporary file beside `path` for writing, renamed into place on success"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Write a file under a temporary name and rename it into place"""
+    with atomic_output(path) as f:
+        f.write(data)
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reflink(source: str, target: str) -> None:
+    """Create `target` as a copy-on-write clone of `source`, raising OSError where unsupported"""
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_or_copy(source: str, target: str) -> None:
+    """Atomically place `source` at `target` as a hardlink, else a reflink, else a copy"""
+    if os.path.exists(target) and os.path.samefile(source, target):
+        # Already linked; renaming a link over itself would leave the temp name behind
+        return
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        _clone(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def clone_or_copy(source: str, target: str) -> None:
+    """Atomically place an independent copy of `source` at `target`: a reflink, else a copy"""
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    _clone(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def _clone(source: str, target: str) -> None:
+    try:
+        reflink(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class ImageCache:
+    """Content-addressed on-disk cache of generated images.
+
+    Images are stored once per content hash under blobs/, and an SQLite
+    index maps each request key (see `request_key`) to its blob. A hit is
+    one indexed lookup plus a reflink (or copy) of the blob to the output
+    path, so no API call is made. Blobs never share an inode with an output
+    file, so rewriting an output in place cannot corrupt the cache; they
+    are read-only, and a blob whose size no longer matches the index is
+    dropped on lookup.
+
+    The cache is bounded by `max_bytes`: `put_file` evicts the least recently
+    used blobs, with their request keys, once the total grows past it.
+    """
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        # Shared by the request threads of one generator
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, INDEX_FILE), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs "
+                "(digest TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, digest TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_digest ON entries (digest)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_last_used ON blobs (last_used)")
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, "blobs", digest[:2], f"{digest}.png")
+
+    def get(self, key: str) -> Optional[str]:
+        """Blob path cached for a request key, marking it recently used, or None"""
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT entries.digest, blobs.size FROM entries JOIN blobs ON blobs.digest = entries.digest "
+                "WHERE entries.key = ?", (key,)
+            ).fetchone()
+            if found is None:
+                return None
+            path = self.blob_path(found[0])
+            try:
+                intact = os.path.getsize(path) == found[1]
+            except FileNotFoundError:
+                intact = False
+            if not intact:
+                # Blob removed or modified behind our back; forget it
+                with self._conn:
+                    self._conn.execute("DELETE FROM entries WHERE digest = ?", (found[0],))
+                    self._conn.execute("DELETE FROM blobs WHERE digest = ?", (found[0],))
+                if os.path.exists(path):
+                    os.remove(path)
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), found[0]))
+            return path
+
+    def put_file(self, key: str, source: str) -> str:
+        """Store an image file for a request key and return its blob path.
+
+        The blob is a reflink or copy of the file, never a hardlink, so the
+        caller's file stays writable and later changes to it do not reach
+        the cache. The copy is hashed, so the blob always matches its digest.
+        """
+        incoming = os.path.join(self.root, "blobs", f"incoming.{os.getpid()}.{threading.get_ident()}.tmp")
+        os.makedirs(os.path.dirname(incoming), exist_ok=True)
+        _clone(source, incoming)
+        try:
+            digest = file_digest(incoming)
+            path = self.blob_path(digest)
+            size = os.path.getsize(incoming)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.chmod(incoming, 0o444)
+                os.replace(incoming, path)
+        finally:
+            if os.path.exists(incoming):
+                os.remove(incoming)
+        self._add_entry(key, digest, size)
+        return path
+
+    def _add_entry(self, key: str, digest: str, size: int) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO blobs (digest, size, last_used) VALUES (?, ?, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET last_used = excluded.last_used",
+                (digest, size, now)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, digest, created) VALUES (?, ?, ?)",
+                (key, digest, now)
+            )
+        if self.total_size() > self.max_bytes:
+            self.prune(max_bytes=self.max_bytes)
+
+    def total_size(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def entries(self) -> List[Dict]:
+        """Every cached request, most recently used first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entries.key, entries.digest, blobs.size, blobs.last_used, entries.created "
+                "FROM entries JOIN blobs ON blobs.digest = entries.digest "
+                "ORDER BY blobs.last_used DESC"
+            ).fetchall()
+        return [
+            {"key": key, "digest": digest, "size": size, "last_used": last_used, "created": created}
+            for key, digest, size, last_used, created in rows
+        ]
+
+    def prune(self, max_bytes: int = None, older_than: float = None) -> int:
+        """Evict blobs unused for `older_than` seconds, then least recently used
+        blobs until the cache fits in `max_bytes`. Returns the number of blobs removed.
+        """
+        with self._lock:
+            blobs = self._conn.execute(
+                "SELECT digest, size, last_used FROM blobs ORDER BY last_used"
+            ).fetchall()
+            total = sum(size for _, size, _ in blobs)
+            cutoff = time.time() - older_than if older_than is not None else None
+            evicted = []
+            for digest, size, last_used in blobs:
+                expired = cutoff is not None and last_used < cutoff
+                oversized = max_bytes is not None and total > max_bytes
+                if not (expired or oversized):
+                    # Blobs are in LRU order, so none of the rest qualify either
+                    break
+                evicted.append(digest)
+                total -= size
+
+            with self._conn:
+                self._conn.executemany("DELETE FROM entries WHERE digest = ?", [(d,) for d in evicted])
+                self._conn.executemany("DELETE FROM blobs WHERE digest = ?", [(d,) for d in evicted])
+        for digest in evicted:
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+        return len(evicted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List or prune the generated image cache")
+    parser.add_argument("command", choices=["list", "prune"])
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Cache directory")
+    parser.add_argument("--max-mb", type=float, default=None,
+                        help="Prune least recently used images until the cache fits in this many MB")
+    parser.add_argument("--older-than-days", type=float, default=None,
+                        help="Prune images not used for this many days")
+    args = parser.parse_args()
+
+    cache = ImageCache(args.cache_dir)
+    if args.command == "list":
+        entries = cache.entries()
+        for entry in entries:
+            last_used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_used"]))
+            print(f"{entry['key'][:16]}  {entry['digest'][:16]}  {entry['size']:>10}  {last_used}")
+        print(f"{len(entries)} entries, {cache.total_size() / 1024 ** 2:.1f} MB")
+    else:
+        max_bytes = int(args.max_mb * 1024 ** 2) if args.max_mb is not None else None
+        older_than = args.older_than_days * 86400 if args.older_than_days is not None else None
+        removed = cache.prune(max_bytes=max_bytes, older_than=older_than)
+        print(f"Removed {removed} images, {cache.total_size() / 1024 ** 2:.1f} MB left")
+    cache.close()
+
+if __name__ == "__main__":
+    main()
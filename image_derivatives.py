@@ -0,0 +1,250 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from image_cache import atomic_output, write_atomic
+from token_layout import TokenLayout
+
+DEFAULT_OUTPUT_DIR = "nft_images_derivatives"
+
+# Longest side, in pixels, of each derivative
+DEFAULT_SIZES = (512, 256, 64)
+
+# Records the source each derivative was built from, to skip up-to-date tokens
+STATE_FILE = "sources.json"
+
+# Resampling per mode: (halving, final resize)
+RESAMPLING = {
+    # Keeps pixel-art edges hard and adds no colours
+    "nearest": (Image.Resampling.NEAREST, Image.Resampling.NEAREST),
+    # For painted or photographic outputs
+    "smooth": (Image.Resampling.BOX, Image.Resampling.LANCZOS),
+}
+
+# Images per task sent to a worker
+CHUNK_SIZE = 32
+
+# Options and layouts installed in each worker process by _init_worker
+_worker_options = None
+
+
+def _init_worker(input_root: str, output_root: str, fanout: int, options: Dict):
+    global _worker_options
+    _worker_options = {
+        "source": TokenLayout(input_root, ".png"),
+        "targets": size_layouts(output_root, options["sizes"], fanout),
+        **options,
+    }
+
+
+def _build_chunk(chunk: List[Tuple[int, Optional[str]]]):
+    """Build the derivatives of one chunk of tokens in a worker"""
+    return build_tokens(chunk, **_worker_options)
+
+
+def size_layouts(output_dir: str, sizes: Sequence[int], fanout: int = None) -> Dict[int, TokenLayout]:
+    """One layout per derivative size, under <output_dir>/<size>/"""
+    return {size: TokenLayout(os.path.join(output_dir, str(size)), ".png", fanout) for size in sizes}
+
+
+def fit(width: int, height: int, size: int) -> Tuple[int, int]:
+    """Dimensions with the longest side scaled to `size`, keeping the aspect ratio"""
+    scale = size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def build_pyramid(image: Image.Image, sizes: Sequence[int], resample: str = "nearest") -> Dict[int, Image.Image]:
+    """
+    Scale one decoded image to every size, largest first.
+
+    Each size starts from the previous level, halved while it stays at
+    least twice the target, so every source pixel is read only by the
+    first halving and the final resize of each size is small. Sizes at or
+    above the source are resized from the source directly.
+
+    Returns:
+        dict: size -> image
+    """
+    halve, final = RESAMPLING[resample]
+    levels = {}
+    current = image
+    for size in sorted(set(sizes), reverse=True):
+        target = fit(image.width, image.height, size)
+        if target[0] >= image.width:
+            levels[size] = image if target == image.size else image.resize(target, final)
+            continue
+        while current.width // 2 >= target[0] and current.height // 2 >= target[1]:
+            current = current.resize((current.width // 2, current.height // 2), halve)
+        levels[size] = current if current.size == target else current.resize(target, final)
+    return levels
+
+
+def build_tokens(chunk: List[Tuple[int, Optional[str]]], source: TokenLayout,
+                 targets: Dict[int, TokenLayout], sizes: Sequence[int], resample: str):
+    """
+    Build the derivatives of (token_id, digest of the last source built) pairs.
+
+    A token whose source still has that digest and whose derivatives all
+    exist is not decoded again. Failures are returned, not raised.
+
+    Returns:
+        list: (token_id, {"status": "built" | "unchanged", "digest": ...} or {"error": message})
+    """
+    results = []
+    for token_id, known_digest in chunk:
+        try:
+            # Read once for both the hash and the decode
+            with open(source.path(token_id), "rb") as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            if digest == known_digest and all(os.path.exists(targets[size].path(token_id)) for size in sizes):
+                results.append((token_id, {"status": "unchanged", "digest": digest}))
+                continue
+
+            with Image.open(io.BytesIO(data)) as image:
+                image.load()
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                for size, level in build_pyramid(image, sizes, resample).items():
+                    with atomic_output(targets[size].output_path(token_id)) as out:
+                        level.save(out, format="PNG")
+            results.append((token_id, {"status": "built", "digest": digest}))
+        except (OSError, ValueError) as e:
+            results.append((token_id, {"error": str(e)}))
+    return results
+
+
+def load_state(output_dir: str, settings: Dict) -> Dict[str, List]:
+    """token_id -> [source size, source mtime_ns, source digest] from the last run with the same settings"""
+    try:
+        with open(os.path.join(output_dir, STATE_FILE)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return state.get("tokens", {}) if state.get("settings") == settings else {}
+
+
+def save_state(output_dir: str, settings: Dict, tokens: Dict[str, List]) -> None:
+    data = json.dumps({"settings": settings, "tokens": tokens}, separators=(",", ":")).encode()
+    write_atomic(os.path.join(output_dir, STATE_FILE), data)
+
+
+def generate_derivatives(input_dir: str, output_dir: str = DEFAULT_OUTPUT_DIR,
+                         sizes: Sequence[int] = DEFAULT_SIZES, resample: str = "nearest",
+                         workers: int = None, force: bool = False) -> Dict[int, Dict]:
+    """
+    Build every configured size of every token image under input_dir in a process pool.
+
+    Each size goes to <output_dir>/<size>/ with the input's directory layout
+    and manifest. A token is skipped without being read when its source
+    size and mtime match the last build, and without being decoded when
+    its content hash does; changing sizes or resample rebuilds everything.
+
+    Returns:
+        dict: token_id -> {"status": "built" | "unchanged" | "up to date"} or {"error": message}
+    """
+    if resample not in RESAMPLING:
+        raise ValueError(f"Unknown resample mode {resample!r}, expected one of {', '.join(RESAMPLING)}")
+    sizes = sorted(set(sizes), reverse=True)
+    settings = {"sizes": sizes, "resample": resample}
+    source = TokenLayout(input_dir, ".png")
+    targets = size_layouts(output_dir, sizes, source.fanout)
+    for target in targets.values():
+        target.prepare()
+    state = {} if force else load_state(output_dir, settings)
+
+    results = {}
+    stats = {}
+    pending_ids = []
+    for token_id in source.token_ids():
+        try:
+            st = os.stat(source.path(token_id))
+        except OSError as e:
+            results[token_id] = {"error": str(e)}
+            continue
+        stats[token_id] = [st.st_size, st.st_mtime_ns]
+        entry = state.get(str(token_id))
+        if (entry is not None and entry[:2] == stats[token_id]
+                and all(os.path.exists(targets[size].path(token_id)) for size in sizes)):
+            results[token_id] = {"status": "up to date"}
+        else:
+            pending_ids.append((token_id, entry[2] if entry is not None else None))
+
+    chunks = [pending_ids[i:i + CHUNK_SIZE] for i in range(0, len(pending_ids), CHUNK_SIZE)]
+    options = {"sizes": sizes, "resample": resample}
+    workers = workers or os.cpu_count() or 1
+
+    def collect(chunk_results):
+        built = []
+        for token_id, info in chunk_results:
+            results[token_id] = info
+            if "error" in info:
+                state.pop(str(token_id), None)
+            else:
+                state[str(token_id)] = stats[token_id] + [info["digest"]]
+                built.append(token_id)
+        for target in targets.values():
+            target.record(built)
+
+    started = time.monotonic()
+    try:
+        if workers == 1:
+            for chunk in chunks:
+                collect(build_tokens(chunk, source, targets, **options))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(input_dir, output_dir, source.fanout, options)) as pool:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.submit(_build_chunk, chunk))
+                    if len(pending) >= workers * 2:
+                        collect(pending.popleft().result())
+                while pending:
+                    collect(pending.popleft().result())
+    finally:
+        # Keep the progress of an interrupted run
+        save_state(output_dir, settings, state)
+    seconds = time.monotonic() - started
+
+    counts = {}
+    for info in results.values():
+        status = info.get("status", "failed")
+        counts[status] = counts.get(status, 0) + 1
+    print(f"✓ Derivatives at {', '.join(map(str, sizes))} px in {seconds:.1f}s: "
+          f"{counts.get('built', 0)} images built, "
+          f"{counts.get('up to date', 0) + counts.get('unchanged', 0)} already up to date")
+    failed = sorted(token_id for token_id, info in results.items() if "error" in info)
+    if failed:
+        print(f"⚠ {len(failed)} images could not be processed: tokens {failed[:20]}"
+              f"{' ...' if len(failed) > 20 else ''}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build thumbnails of every token image at several sizes, skipping up-to-date ones"
+    )
+    parser.add_argument("input_dir", nargs="?", default="nft_images", help="Directory of token images")
+    parser.add_argument("output_dir", nargs="?", default=DEFAULT_OUTPUT_DIR,
+                        help="Where to write <size>/ directories of derivatives")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Longest side of each derivative, in pixels")
+    parser.add_argument("--resample", choices=list(RESAMPLING), default="nearest",
+                        help="nearest for pixel art, smooth for painted images")
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="Rebuild every derivative")
+    args = parser.parse_args()
+
+    generate_derivatives(args.input_dir, args.output_dir, sizes=args.sizes, resample=args.resample,
+                         workers=args.workers, force=args.force)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_cache import atomic_output
+from token_layout import TokenLayout
+
+DEFAULT_OUTPUT_DIR = "nft_images_native"
+
+# Palette size of the processed images
+DEFAULT_COLORS = 32
+
+# Largest pixel-art cell, in source pixels, that grid detection looks for
+MAX_CELL = 128
+
+# Share of the strong edges that must fall on a candidate grid's lines
+GRID_THRESHOLD = 0.6
+
+# Colour change (summed over channels) between neighbouring pixels that counts as an edge
+EDGE_MIN = 48
+
+# Images per task sent to a worker
+CHUNK_SIZE = 32
+
+# Options and layouts installed in each worker process by _init_worker
+_worker_options = None
+
+
+def _init_worker(input_root: str, output_root: str, fanout: int, options: Dict):
+    global _worker_options
+    _worker_options = {
+        "source": TokenLayout(input_root, ".png"),
+        "target": TokenLayout(output_root, ".png", fanout),
+        **options,
+    }
+
+
+def _process_chunk(token_ids: List[int]):
+    """Post-process one chunk of token images in a worker"""
+    return process_tokens(token_ids, **_worker_options)
+
+
+def edge_profiles(pixels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Number of strong edges between each pair of neighbouring columns, and of rows"""
+    data = pixels.astype(np.int16)
+    across = np.abs(np.diff(data, axis=1)).sum(axis=2) > EDGE_MIN
+    down = np.abs(np.diff(data, axis=0)).sum(axis=2) > EDGE_MIN
+    return across.sum(axis=0), down.sum(axis=1)
+
+
+def _peaks(profile: np.ndarray) -> np.ndarray:
+    """Keep only local maxima, so an edge softened over a few pixels counts once, at its centre"""
+    padded = np.pad(profile, 1)
+    return np.where((profile >= padded[:-2]) & (profile >= padded[2:]), profile, 0)
+
+
+def _grid_hits(profile: np.ndarray, cell: int) -> Tuple[float, int]:
+    # Entry i of a profile is the boundary in front of pixel i + 1
+    sums = np.bincount(np.arange(1, len(profile) + 1) % cell, weights=profile, minlength=cell)
+    offset = int(sums.argmax())
+    return sums[offset], offset
+
+
+def detect_grid(pixels: np.ndarray, max_cell: int = MAX_CELL,
+                threshold: float = GRID_THRESHOLD) -> Tuple[int, int, int]:
+    """
+    Find the pixel-art grid an upscaled image was drawn on.
+
+    A candidate cell size fits when at least `threshold` of the strong
+    edges lie on lines that far apart. Every divisor of the true cell fits
+    too, and multiples of it catch at most half the edges, so the largest
+    fitting size is the cell.
+
+    Returns:
+        tuple: (cell size, x offset, y offset) of the grid; a cell size of
+        1 means no coarser grid was found
+    """
+    across, down = (_peaks(profile) for profile in edge_profiles(pixels))
+    total = across.sum() + down.sum()
+    grid = (1, 0, 0)
+    if total == 0:
+        return grid
+    for cell in range(2, min(max_cell, *pixels.shape[:2]) + 1):
+        hits_x, offset_x = _grid_hits(across, cell)
+        hits_y, offset_y = _grid_hits(down, cell)
+        if (hits_x + hits_y) / total >= threshold:
+            grid = (cell, offset_x, offset_y)
+    return grid
+
+
+def downsample(pixels: np.ndarray, cell: int, offset_x: int = 0, offset_y: int = 0) -> np.ndarray:
+    """Nearest-neighbour downscale to one pixel per grid cell, sampling cell centres.
+    Partial cells at the edges are dropped.
+    """
+    if cell <= 1:
+        return pixels
+    height, width = pixels.shape[:2]
+    rows = np.arange(offset_y + cell // 2, height - (height - offset_y) % cell, cell)
+    cols = np.arange(offset_x + cell // 2, width - (width - offset_x) % cell, cell)
+    return pixels[np.ix_(rows, cols)]
+
+
+def quantize(image: Image.Image, colors: int) -> Image.Image:
+    """Reduce to a palette image of at most `colors` colours, without dithering"""
+    if image.mode == "RGBA" and image.getextrema()[3][0] < 255:
+        # Only the octree quantizer keeps transparency
+        return image.quantize(colors=colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    return image.convert("RGB").quantize(colors=colors, method=Image.Quantize.MEDIANCUT,
+                                         dither=Image.Dither.NONE)
+
+
+def process_image(source: str, target: str, colors: int = DEFAULT_COLORS, cell_size: int = None) -> Dict:
+    """
+    Shrink one generated image to its native pixel grid, quantize it and
+    write an optimized PNG to target (atomically, so source may equal target).
+
+    cell_size skips grid detection, e.g. 64 for 16x16 sprites rendered at 1024x1024.
+
+    Returns:
+        dict: cell size, native width and height, and bytes before and after
+    """
+    with Image.open(source) as image:
+        image = image.convert("RGBA")
+    pixels = np.asarray(image)
+    if cell_size is not None:
+        grid = (cell_size, 0, 0)
+    else:
+        grid = detect_grid(pixels)
+    native = Image.fromarray(downsample(pixels, *grid), "RGBA")
+    before = os.path.getsize(source)
+
+    with atomic_output(target) as f:
+        quantize(native, colors).save(f, format="PNG", optimize=True)
+    return {
+        "cell": grid[0], "width": native.width, "height": native.height,
+        "bytes_before": before, "bytes_after": os.path.getsize(target),
+    }
+
+
+def process_tokens(token_ids: List[int], source: TokenLayout, target: TokenLayout, **options):
+    """Post-process token images from one layout into another; failures are returned, not raised"""
+    results = []
+    for token_id in token_ids:
+        try:
+            results.append((token_id, process_image(source.path(token_id), target.output_path(token_id),
+                                                    **options)))
+        except (OSError, ValueError) as e:
+            results.append((token_id, {"error": str(e)}))
+    return results
+
+
+def post_process_images(input_dir: str, output_dir: str = DEFAULT_OUTPUT_DIR, colors: int = DEFAULT_COLORS,
+                        cell_size: int = None, workers: int = None) -> Dict[int, Dict]:
+    """
+    Post-process every token image under input_dir into output_dir in a process pool.
+
+    output_dir keeps the input's directory layout and manifest, and may be
+    input_dir itself to replace the images in place.
+
+    Returns:
+        dict: token_id -> process_image stats, or {"error": message}
+    """
+    source = TokenLayout(input_dir, ".png")
+    target = TokenLayout(output_dir, ".png", source.fanout)
+    target.prepare()
+    token_ids = source.token_ids()
+    options = {"colors": colors, "cell_size": cell_size}
+    chunks = [token_ids[i:i + CHUNK_SIZE] for i in range(0, len(token_ids), CHUNK_SIZE)]
+    workers = workers or os.cpu_count() or 1
+    results = {}
+
+    def collect(chunk_results):
+        for token_id, info in chunk_results:
+            results[token_id] = info
+        target.record(token_id for token_id, info in chunk_results if "error" not in info)
+
+    started = time.monotonic()
+    if workers == 1:
+        for chunk in chunks:
+            collect(process_tokens(chunk, source, target, **options))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(input_dir, output_dir, source.fanout, options)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_process_chunk, chunk))
+                if len(pending) >= workers * 2:
+                    collect(pending.popleft().result())
+            while pending:
+                collect(pending.popleft().result())
+    seconds = time.monotonic() - started
+
+    done = [info for info in results.values() if "error" not in info]
+    before = sum(info["bytes_before"] for info in done)
+    after = sum(info["bytes_after"] for info in done)
+    print(f"✓ Post-processed {len(done)} images in {seconds:.1f}s: "
+          f"{before / 1024 ** 2:.1f} MB -> {after / 1024 ** 2:.2f} MB"
+          f"{f' ({before / after:.0f}x smaller)' if after else ''}")
+    failed = sorted(token_id for token_id, info in results.items() if "error" in info)
+    if failed:
+        print(f"⚠ {len(failed)} images could not be processed: tokens {failed[:20]}"
+              f"{' ...' if len(failed) > 20 else ''}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Shrink generated images to their native pixel grid with a limited palette"
+    )
+    parser.add_argument("input_dir", nargs="?", default="nft_images", help="Directory of token images")
+    parser.add_argument("output_dir", nargs="?", default=DEFAULT_OUTPUT_DIR,
+                        help="Where to write the processed images (may equal input_dir)")
+    parser.add_argument("--colors", type=int, default=DEFAULT_COLORS, help="Palette size")
+    parser.add_argument("--cell-size", type=int, default=None,
+                        help="Source pixels per art pixel, instead of detecting the grid")
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    post_process_images(args.input_dir, args.output_dir, colors=args.colors,
+                        cell_size=args.cell_size, workers=args.workers)
+
+if __name__ == "__main__":
+    main()
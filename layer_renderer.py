@@ -0,0 +1,239 @@
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+from generate_pfp import GenerationResult, STATUS_OK, STATUS_FAILED
+from image_cache import atomic_output
+from token_layout import TokenLayout
+
+DEFAULT_LAYERS_DIR = "layers"
+
+# Drawing order, back to front; a token can have several Outfit layers
+LAYER_ORDER = ("Background", "Base", "Hair Color", "Eyes", "Expression", "Outfit", "Special Effect")
+
+# Trait values that draw nothing
+EMPTY_VALUES = {"None", ""}
+
+# Leading layers whose composite is shared between tokens (Background + Base)
+PREFIX_DEPTH = 2
+
+# Memory for cached prefix composites, per process
+PREFIX_CACHE_BYTES = 256 * 1024 ** 2
+
+# Tokens per task sent to a render worker
+CHUNK_SIZE = 64
+
+# Renderer and output layout installed in each worker process by _init_worker
+_worker_renderer = None
+_worker_layout = None
+
+
+def _init_worker(renderer, root: str, fanout: int):
+    global _worker_renderer, _worker_layout
+    _worker_renderer = renderer
+    _worker_layout = TokenLayout(root, ".png", fanout)
+
+
+def _render_chunk(chunk: List[Tuple[int, List]]):
+    """Render one chunk of tokens in a worker; only paths and counters travel back"""
+    return _worker_renderer.render_chunk(chunk, _worker_layout)
+
+
+class LayerRenderer:
+    """Offline image backend that composites per-trait PNG layers with Pillow.
+
+    Layers use the trait vocabulary of config.py and live at
+    <layers_dir>/<trait type>/<value>.png, e.g. layers/Background/Forest.png,
+    layers/Base/Wizard.png or layers/Outfit/Staff.png. They are drawn back to
+    front in LAYER_ORDER and must all be the same size; a trait value with
+    no layer file is skipped and reported. `scale` upscales the result with
+    nearest-neighbour resampling, so small pixel-art layers stay crisp.
+
+    Decoded layers are cached per process, and the composite of the first
+    `prefix_depth` layers (background + base) is kept in an LRU bounded by
+    `prefix_cache_bytes`, so tokens sharing it only pay for their remaining
+    layers. `render_tokens` spreads tokens over a process pool.
+    """
+
+    def __init__(self, layers_dir: str = DEFAULT_LAYERS_DIR, scale: int = 1,
+                 prefix_depth: int = PREFIX_DEPTH, prefix_cache_bytes: int = PREFIX_CACHE_BYTES):
+        if not os.path.isdir(layers_dir):
+            raise ValueError(f"Layer directory {layers_dir} does not exist")
+        self.layers_dir = layers_dir
+        self.scale = scale
+        self.prefix_depth = prefix_depth
+        self.prefix_cache_bytes = prefix_cache_bytes
+        self._reset_caches()
+
+    def _reset_caches(self):
+        self._layers = {}
+        self._prefixes = OrderedDict()
+        self._prefix_bytes = 0
+        self.missing = set()
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+
+    def __getstate__(self):
+        # Caches stay in the process that filled them
+        return {
+            "layers_dir": self.layers_dir, "scale": self.scale,
+            "prefix_depth": self.prefix_depth, "prefix_cache_bytes": self.prefix_cache_bytes,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_caches()
+
+    @staticmethod
+    def layer_keys(attributes) -> List[Tuple[str, str]]:
+        """(trait type, value) of every layer a token draws, back to front"""
+        values = {}
+        for attr in attributes:
+            values.setdefault(attr["trait_type"], []).append(str(attr["value"]))
+        return [
+            (trait_type, value) for trait_type in LAYER_ORDER
+            for value in values.get(trait_type, []) if value not in EMPTY_VALUES
+        ]
+
+    def layer(self, trait_type: str, value: str) -> Optional[Image.Image]:
+        """Decoded RGBA layer for a trait value, or None if it has no file"""
+        key = (trait_type, value)
+        if key not in self._layers:
+            path = os.path.join(self.layers_dir, trait_type, f"{value}.png")
+            if os.path.isfile(path):
+                with Image.open(path) as image:
+                    self._layers[key] = image.convert("RGBA")
+            else:
+                self._layers[key] = None
+                self.missing.add(f"{trait_type}/{value}")
+        return self._layers[key]
+
+    @staticmethod
+    def _flatten(layers, canvas=None) -> Image.Image:
+        for (trait_type, value), image in layers:
+            if canvas is None:
+                # Layers are never modified, so the first can serve as the canvas
+                canvas = image
+            elif image.size != canvas.size:
+                raise ValueError(f"Layer {trait_type}/{value} is {image.size[0]}x{image.size[1]}, "
+                                 f"expected {canvas.size[0]}x{canvas.size[1]}")
+            else:
+                canvas = Image.alpha_composite(canvas, image)
+        return canvas
+
+    def _cached_prefix(self, layers) -> Image.Image:
+        key = tuple(layer_key for layer_key, _ in layers)
+        canvas = self._prefixes.get(key)
+        if canvas is not None:
+            self._prefixes.move_to_end(key)
+            self.prefix_hits += 1
+            return canvas
+
+        self.prefix_misses += 1
+        canvas = self._flatten(layers)
+        self._prefixes[key] = canvas
+        self._prefix_bytes += canvas.width * canvas.height * 4
+        while self._prefix_bytes > self.prefix_cache_bytes and len(self._prefixes) > 1:
+            _, evicted = self._prefixes.popitem(last=False)
+            self._prefix_bytes -= evicted.width * evicted.height * 4
+        return canvas
+
+    def render(self, attributes) -> Image.Image:
+        """Composite a token's layers into one RGBA image"""
+        layers = [(key, image) for key in self.layer_keys(attributes)
+                  for image in [self.layer(*key)] if image is not None]
+        if not layers:
+            raise ValueError("None of the token's traits has a layer file")
+
+        depth = min(self.prefix_depth, len(layers))
+        if depth >= 2:
+            canvas = self._flatten(layers[depth:], self._cached_prefix(layers[:depth]))
+        else:
+            canvas = self._flatten(layers)
+        if self.scale != 1:
+            canvas = canvas.resize((canvas.width * self.scale, canvas.height * self.scale),
+                                   Image.Resampling.NEAREST)
+        return canvas
+
+    def render_to(self, attributes, output_file: str) -> GenerationResult:
+        """Render a token and save it as a PNG, written under a temporary name and renamed into place"""
+        started = time.monotonic()
+        try:
+            image = self.render(attributes)
+            with atomic_output(str(output_file)) as f:
+                image.save(f, format="PNG")
+        except (OSError, ValueError) as e:
+            return GenerationResult(STATUS_FAILED, 0, error=str(e), elapsed=time.monotonic() - started)
+        return GenerationResult(STATUS_OK, 0, path=str(output_file), elapsed=time.monotonic() - started)
+
+    def render_chunk(self, chunk: List[Tuple[int, List]], layout: TokenLayout):
+        """Render a list of (token_id, attributes) to their layout paths"""
+        results = [
+            (token_id, self.render_to(attributes, layout.output_path(token_id)))
+            for token_id, attributes in chunk
+        ]
+        # Counters are reported as deltas so the parent can sum them
+        counters = (self.prefix_hits, self.prefix_misses)
+        self.prefix_hits = self.prefix_misses = 0
+        missing, self.missing = self.missing, set()
+        return results, missing, counters
+
+    def render_tokens(self, tokens: Iterable[Tuple[int, List]], layout: TokenLayout,
+                      workers: int = None,
+                      on_result: Callable[[int, GenerationResult], None] = None) -> Dict[int, GenerationResult]:
+        """
+        Render (token_id, attributes) pairs into a layout in a process pool.
+
+        Tokens are consumed lazily in chunks, with a bounded number of chunks
+        in flight. With workers=1 everything renders in this process.
+
+        Returns:
+            dict: token_id -> GenerationResult
+        """
+        workers = workers or os.cpu_count() or 1
+        tokens = iter(tokens)
+        chunks = iter(lambda: list(islice(tokens, CHUNK_SIZE)), [])
+        results = {}
+        hits = misses = 0
+        missing = set()
+
+        def collect(rendered):
+            nonlocal hits, misses
+            chunk_results, chunk_missing, (chunk_hits, chunk_misses) = rendered
+            missing.update(chunk_missing)
+            hits += chunk_hits
+            misses += chunk_misses
+            for token_id, result in chunk_results:
+                results[token_id] = result
+                if on_result is not None:
+                    on_result(token_id, result)
+
+        started = time.monotonic()
+        if workers == 1:
+            for chunk in chunks:
+                collect(self.render_chunk(chunk, layout))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self, layout.root, layout.fanout)) as pool:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.submit(_render_chunk, chunk))
+                    # Keep every worker busy without reading all tokens up front
+                    if len(pending) >= workers * 2:
+                        collect(pending.popleft().result())
+                while pending:
+                    collect(pending.popleft().result())
+
+        seconds = time.monotonic() - started
+        print(f"✓ Rendered {len(results)} images from layers in {seconds:.1f}s "
+              f"({len(results) / seconds if seconds else 0:.1f} images/s, "
+              f"{hits}/{hits + misses} background+base composites reused)")
+        if missing:
+            print(f"⚠ No layer file for {len(missing)} trait values: {', '.join(sorted(missing)[:20])}"
+                  f"{' ...' if len(missing) > 20 else ''}")
+        return results
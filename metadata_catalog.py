@@ -0,0 +1,161 @@
+import json
+import os
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+CATALOG_FILE = "catalog.sqlite3"
+
+# Rows buffered per INSERT transaction
+TRANSACTION_SIZE = 50000
+
+
+def _quote(name: str) -> str:
+    """Quote a trait name for use as an SQL identifier ("Special Effect")"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+class MetadataCatalog:
+    """SQLite catalog of token metadata with one row per token.
+
+    Every trait column is a TEXT column with its own index and every RPG
+    stat an INTEGER column, so questions like "all Pirates with Fire effect
+    and Luck > 90" are answered by SQLite instead of by re-reading every
+    metadata file. The full record is kept alongside as compact JSON, and
+    rows are inserted in transactions of TRANSACTION_SIZE.
+
+    Opening an existing catalog reads its columns from the table, so
+    `trait_types` and `stat_names` are only needed to create one.
+    """
+
+    def __init__(self, path: str, trait_types: Sequence[str] = (), stat_names: Sequence[str] = ()):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(path, CATALOG_FILE))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._pending: List[Tuple] = []
+
+        columns = self._conn.execute("PRAGMA table_info(tokens)").fetchall()
+        if columns:
+            self.trait_types = [name for _, name, kind, *_ in columns if kind == "TEXT" and name != "metadata"]
+            self.stat_names = [name for _, name, kind, *_ in columns if kind == "INTEGER" and name != "token_id"]
+        elif trait_types:
+            self.trait_types = list(trait_types)
+            self.stat_names = list(stat_names)
+            self._create()
+        else:
+            raise ValueError(f"No metadata catalog at {path} and no trait columns to create one")
+
+        names = ["token_id", *self.trait_types, *self.stat_names, "metadata"]
+        self._insert = (
+            f"INSERT OR REPLACE INTO tokens ({', '.join(_quote(name) for name in names)}) "
+            f"VALUES ({', '.join('?' * len(names))})"
+        )
+
+    def _create(self) -> None:
+        columns = ["token_id INTEGER PRIMARY KEY"]
+        columns += [f"{_quote(name)} TEXT" for name in self.trait_types]
+        columns += [f"{_quote(name)} INTEGER" for name in self.stat_names]
+        columns.append("metadata TEXT NOT NULL")
+        with self._conn:
+            self._conn.execute(f"CREATE TABLE tokens ({', '.join(columns)})")
+            for name in self.trait_types:
+                index = _quote("idx_" + name.lower().replace(" ", "_"))
+                self._conn.execute(f"CREATE INDEX {index} ON tokens ({_quote(name)})")
+
+    @staticmethod
+    def is_catalog(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, CATALOG_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self) -> None:
+        if self._conn is None:
+            return
+        self.flush()
+        self._conn.close()
+        self._conn = None
+
+    # Writing
+
+    def row(self, token_id: int, metadata: Dict) -> Tuple:
+        """Flatten one token's metadata into a catalog row"""
+        values = {attr["trait_type"]: attr["value"] for attr in metadata["attributes"]}
+        return (
+            token_id,
+            *(values.get(name) for name in self.trait_types),
+            *(values.get(name) for name in self.stat_names),
+            json.dumps(metadata, separators=(",", ":"))
+        )
+
+    def add(self, token_id: int, metadata: Dict) -> None:
+        """Queue one token; rows are written once a full transaction is buffered"""
+        self._pending.append(self.row(token_id, metadata))
+        if len(self._pending) >= TRANSACTION_SIZE:
+            self.flush()
+
+    def add_rows(self, rows: Iterable[Tuple]) -> None:
+        """Insert ready-made rows (see `row`) in one transaction"""
+        self.flush()
+        with self._conn:
+            self._conn.executemany(self._insert, rows)
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        with self._conn:
+            self._conn.executemany(self._insert, rows)
+
+    # Reading
+
+    def _where(self, traits: Dict = None, where: str = None, params: Sequence = ()) -> Tuple[str, List]:
+        clauses, values = [], []
+        for name, value in (traits or {}).items():
+            clauses.append(f"{_quote(name)} = ?")
+            values.append(value)
+        if where:
+            clauses.append(f"({where})")
+            values.extend(params)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), values
+
+    def select(self, traits: Dict = None, where: str = None,
+               params: Sequence = ()) -> Iterator[Tuple[int, Dict]]:
+        """Yield (token_id, metadata) for matching tokens in token order.
+
+        `traits` maps trait types to required values; `where` is an extra SQL
+        condition with `params`, e.g. select({"Base": "Pirate"}, "Luck > ?", (90,)).
+        """
+        self.flush()
+        clause, values = self._where(traits, where, params)
+        cursor = self._conn.execute(f"SELECT token_id, metadata FROM tokens{clause} ORDER BY token_id", values)
+        for token_id, metadata in cursor:
+            yield token_id, json.loads(metadata)
+
+    def token_ids(self, traits: Dict = None, where: str = None, params: Sequence = ()) -> List[int]:
+        self.flush()
+        clause, values = self._where(traits, where, params)
+        cursor = self._conn.execute(f"SELECT token_id FROM tokens{clause} ORDER BY token_id", values)
+        return [token_id for token_id, in cursor]
+
+    def count(self, traits: Dict = None, where: str = None, params: Sequence = ()) -> int:
+        self.flush()
+        clause, values = self._where(traits, where, params)
+        return self._conn.execute(f"SELECT COUNT(*) FROM tokens{clause}", values).fetchone()[0]
+
+    def get(self, token_id: int) -> Dict:
+        self.flush()
+        found = self._conn.execute("SELECT metadata FROM tokens WHERE token_id = ?", (token_id,)).fetchone()
+        if found is None:
+            raise KeyError(token_id)
+        return json.loads(found[0])
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def __iter__(self) -> Iterator[Tuple[int, Dict]]:
+        return self.select()
@@ -0,0 +1,165 @@
+import json
+import mmap
+import os
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from metadata_writer import BulkMetadataWriter
+
+DATA_FILE = "records.dat"
+INDEX_FILE = "records.idx"
+
+# One fixed-width index slot per token id: where its record starts in the
+# data file and how long it is. A length of 0 marks a missing token.
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4")])
+
+
+def encode_record(metadata: Dict) -> bytes:
+    """Serialize one record the way it is stored in the data file"""
+    return json.dumps(metadata, separators=(",", ":")).encode("utf-8")
+
+
+def encode_records(records: List[Dict]) -> Tuple[bytes, List[int]]:
+    """Serialize consecutive records into one blob plus their lengths"""
+    encoded = [encode_record(metadata) for metadata in records]
+    return b"".join(encoded), [len(record) for record in encoded]
+
+
+class PackedMetadataStore:
+    """Single-file metadata store with an offset index and mmap reads.
+
+    Records are appended as compact JSON to one data file, and the index
+    file holds a fixed-width slot per token id, so reading any token is one
+    index lookup plus one slice of the memory-mapped data file. Rewriting a
+    token appends a new record and repoints its slot. The per-token JSON
+    directory remains available through `export_json_dir`.
+    """
+
+    def __init__(self, path: str, mode: str = "r"):
+        if mode not in ("r", "a"):
+            raise ValueError(f"Unsupported store mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self._data_path = os.path.join(path, DATA_FILE)
+        self._index_path = os.path.join(path, INDEX_FILE)
+        self._data_file = None
+        self._index_file = None
+        self._next_slot = None
+        self._data_map = None
+        self._index = None
+        self._stale = True
+
+        if mode == "a":
+            os.makedirs(path, exist_ok=True)
+            self._data_file = open(self._data_path, "ab")
+            self._index_file = open(self._index_path, "r+b" if os.path.exists(self._index_path) else "w+b")
+        elif not self.is_store(path):
+            raise FileNotFoundError(f"No packed metadata store at {path}")
+
+    @staticmethod
+    def is_store(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self) -> None:
+        self._release_maps()
+        for f in (self._data_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._data_file = self._index_file = None
+
+    # Writing
+
+    def append(self, token_id: int, metadata: Dict) -> None:
+        """Append one token's record and point its index slot at it"""
+        record = encode_record(metadata)
+        self.append_encoded(token_id, record, [len(record)])
+
+    def append_encoded(self, start_id: int, blob: bytes, lengths: List[int]) -> None:
+        """Append pre-serialized records for tokens [start_id, start_id + len(lengths))"""
+        if self._data_file is None:
+            raise ValueError("Store is not open for appending")
+        offset = self._data_file.tell()
+        self._data_file.write(blob)
+
+        slots = np.zeros(len(lengths), dtype=INDEX_DTYPE)
+        slots["length"] = lengths
+        slots["offset"] = offset + np.concatenate([[0], np.cumsum(lengths[:-1], dtype=np.uint64)])
+        # Sequential token ids are written without seeking
+        if start_id != self._next_slot:
+            self._index_file.seek(start_id * INDEX_DTYPE.itemsize)
+        self._index_file.write(slots.tobytes())
+        self._next_slot = start_id + len(lengths)
+        self._stale = True
+
+    # Reading
+
+    def _release_maps(self) -> None:
+        if self._data_map is not None:
+            self._data_map.close()
+        self._data_map = None
+        self._index = None
+
+    def _refresh(self) -> None:
+        """(Re)map the files after writes so reads see every appended record"""
+        if not self._stale:
+            return
+        if self._data_file is not None:
+            self._data_file.flush()
+            self._index_file.flush()
+        self._release_maps()
+
+        slots = os.path.getsize(self._index_path) // INDEX_DTYPE.itemsize
+        if slots:
+            self._index = np.memmap(self._index_path, dtype=INDEX_DTYPE, mode="r", shape=(slots,))
+        else:
+            self._index = np.zeros(0, dtype=INDEX_DTYPE)
+        if os.path.getsize(self._data_path):
+            with open(self._data_path, "rb") as f:
+                self._data_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._stale = False
+
+    def _slot(self, token_id: int):
+        self._refresh()
+        if not 0 <= token_id < len(self._index) or self._index[token_id]["length"] == 0:
+            raise KeyError(token_id)
+        return self._index[token_id]
+
+    def get(self, token_id: int) -> Dict:
+        """Read one token's metadata in O(1)"""
+        slot = self._slot(token_id)
+        offset, length = int(slot["offset"]), int(slot["length"])
+        return json.loads(self._data_map[offset:offset + length])
+
+    def __contains__(self, token_id: int) -> bool:
+        try:
+            self._slot(token_id)
+        except KeyError:
+            return False
+        return True
+
+    def token_ids(self) -> np.ndarray:
+        """Sorted ids of every stored token, read from the index alone"""
+        self._refresh()
+        return np.flatnonzero(self._index["length"])
+
+    def __len__(self) -> int:
+        return len(self.token_ids())
+
+    def __iter__(self) -> Iterator[Tuple[int, Dict]]:
+        """Yield (token_id, metadata) in token order"""
+        for token_id in self.token_ids().tolist():
+            yield token_id, self.get(token_id)
+
+    def export_json_dir(self, output_dir: str, **writer_options) -> int:
+        """Write every record out as <token_id>.json files"""
+        with BulkMetadataWriter(output_dir, **writer_options) as writer:
+            for token_id, metadata in self:
+                writer.submit(token_id, metadata)
+        return writer.written
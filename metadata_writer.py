@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from collection import TokenView
+from token_layout import TokenLayout
+
+# Written token ids buffered before they are appended to the manifest
+MANIFEST_BATCH = 4096
+
+
+class BulkMetadataWriter:
+    """Writes per-token metadata JSON files, optionally through a thread pool.
+
+    With threads > 0, building, serializing and writing each record happen
+    in worker threads, so file creates and writes overlap instead of
+    blocking one at a time. At most `threads * 4` records are in flight,
+    which keeps memory bounded when fed from a stream. With fsync_every > 0
+    written files are fsynced in groups of that size, followed by one fsync
+    of each directory involved, rather than after every file. `fanout`
+    selects the TokenLayout; None follows whatever layout output_dir has.
+    """
+
+    def __init__(self, output_dir: str, compact: bool = False, threads: int = 0,
+                 fsync_every: int = 0, drop_keys: Tuple[str, ...] = (), fanout: int = None):
+        self.output_dir = output_dir
+        self.compact = compact
+        self.fsync_every = fsync_every
+        self.drop_keys = drop_keys
+        self.written = 0
+
+        self.layout = TokenLayout(output_dir, ".json", fanout)
+        self.layout.prepare()
+        self._pool = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+        self._slots = threading.BoundedSemaphore(threads * 4) if threads > 0 else None
+        self._lock = threading.Lock()
+        self._unsynced: List[str] = []
+        self._unlisted: List[int] = []
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, token_id: int, metadata) -> None:
+        """Queue one record; `metadata` is a dict or a TokenView"""
+        if self._pool is None:
+            self._write(token_id, metadata)
+            return
+        self._slots.acquire()
+        future = self._pool.submit(self._write, token_id, metadata)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        if len(self._futures) >= 1024:
+            # Surface write errors early and keep the pending list short
+            pending = []
+            for f in self._futures:
+                if f.done():
+                    f.result()
+                else:
+                    pending.append(f)
+            self._futures = pending
+
+    def close(self) -> int:
+        """Wait for pending writes, flush outstanding fsyncs and return the file count"""
+        if self._pool is not None:
+            for future in self._futures:
+                future.result()
+            self._futures = []
+            self._pool.shutdown()
+            self._pool = None
+        if self.fsync_every:
+            with self._lock:
+                batch, self._unsynced = self._unsynced, []
+            self._fsync(batch)
+        with self._lock:
+            unlisted, self._unlisted = self._unlisted, []
+        self.layout.record(unlisted)
+        return self.written
+
+    def serialize(self, metadata: Dict) -> str:
+        if self.drop_keys:
+            metadata = {key: value for key, value in metadata.items() if key not in self.drop_keys}
+        if self.compact:
+            return json.dumps(metadata, separators=(",", ":"))
+        return json.dumps(metadata, indent=2)
+
+    def _write(self, token_id: int, metadata) -> None:
+        if isinstance(metadata, TokenView):
+            metadata = metadata.to_dict()
+        text = self.serialize(metadata)
+        path = self.layout.output_path(token_id)
+        with open(path, "w") as f:
+            f.write(text)
+
+        batch = unlisted = None
+        with self._lock:
+            self.written += 1
+            if self.fsync_every:
+                self._unsynced.append(path)
+                if len(self._unsynced) >= self.fsync_every:
+                    batch, self._unsynced = self._unsynced, []
+            if self.layout.fanout:
+                self._unlisted.append(token_id)
+                if len(self._unlisted) >= MANIFEST_BATCH:
+                    unlisted, self._unlisted = self._unlisted, []
+        if batch:
+            self._fsync(batch)
+        if unlisted:
+            self.layout.record(unlisted)
+
+    def _fsync(self, paths: List[str]) -> None:
+        if not paths:
+            return
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        # Make the new directory entries durable as well
+        for directory in {os.path.dirname(path) for path in paths}:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
@@ -0,0 +1,240 @@
+import argparse
+import base64
+import json
+import math
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Same route as the real text-to-image API, for any engine id
+ENDPOINT = re.compile(r"^/v1/generation/[^/]+/text-to-image$")
+
+# Statuses injected by error_rate
+SERVER_ERRORS = (500, 502, 503)
+
+
+def make_png(width: int, height: int, seed: int) -> bytes:
+    """A valid RGB PNG of random noise, so its size stays close to width * height * 3"""
+    rng = random.Random(seed)
+    row_size = width * 3
+    # Each scanline starts with filter type 0 (none)
+    raw = b"".join(b"\x00" + rng.randbytes(row_size) for _ in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+
+def parse_latency(spec: str):
+    """Build a latency sampler from a spec such as "fixed:0.5", "uniform:0.2,1.5",
+    "exponential:0.8" (mean) or "lognormal:1.0,0.5" (median, sigma), all in seconds.
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exponential" and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency spec {spec!r}")
+
+
+class MockStabilityServer(ThreadingHTTPServer):
+    """Local stand-in for the Stability text-to-image endpoint.
+
+    Answers POSTs to /v1/generation/<engine>/text-to-image with `samples`
+    base64 PNG artifacts after a latency drawn from `latency` (see
+    `parse_latency`). Requests beyond `max_concurrency` in flight get a
+    429, and `throttle_rate` / `error_rate` inject 429s and 5xx responses
+    at random; both throttled and 503 responses carry Retry-After when
+    `retry_after` is set. Images are random-noise PNGs of
+    `image_size` x `image_size` pixels, encoded once at startup, so serving
+    costs nothing but the copy. GET /stats returns the request counters.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency="fixed:0", error_rate=0.0,
+                 throttle_rate=0.0, retry_after=None, max_concurrency=None, image_size=1024,
+                 variants=4, api_key=None, seed=None):
+        super().__init__(address, MockStabilityHandler)
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_concurrency = max_concurrency
+        self.api_key = api_key
+        # Artifacts are picked by seed, so different seeds give different images
+        self.images = [base64.b64encode(make_png(image_size, image_size, i)) for i in range(variants)]
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {
+            "requests": 0, "ok": 0, "throttled": 0, "errors": 0, "rejected": 0,
+            "max_in_flight": 0, "bytes_sent": 0,
+        }
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def admit(self):
+        """Decide a request's fate: (status, latency in seconds); 200 counts as in flight"""
+        with self._lock:
+            self.stats["requests"] += 1
+            draw = self._rng.random()
+            if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                status = 429
+            elif draw < self.throttle_rate:
+                status = 429
+            elif draw < self.throttle_rate + self.error_rate:
+                status = self._rng.choice(SERVER_ERRORS)
+            else:
+                status = 200
+                self.in_flight += 1
+                self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+            return status, max(0.0, self.latency(self._rng))
+
+    def finish(self, status: int, sent: int) -> None:
+        with self._lock:
+            if status == 200:
+                self.in_flight -= 1
+                self.stats["ok"] += 1
+            elif status == 429:
+                self.stats["throttled"] += 1
+            elif status in SERVER_ERRORS:
+                self.stats["errors"] += 1
+            else:
+                self.stats["rejected"] += 1
+            self.stats["bytes_sent"] += sent
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections on exit are routine here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, in_flight=self.in_flight)
+
+
+class MockStabilityHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def send_error_json(self, status, message, headers=None):
+        return self.send_body(status, json.dumps({"name": "mock_error", "message": message}).encode(),
+                              headers=headers)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_body(200, json.dumps(self.server.snapshot()).encode())
+        else:
+            self.send_error_json(404, "not found")
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        # Malformed requests are rejected straight away, like the real API
+        if not ENDPOINT.match(self.path):
+            server.finish(404, self.send_error_json(404, "not found"))
+            return
+        if server.api_key is not None and self.headers.get("Authorization") != f"Bearer {server.api_key}":
+            server.finish(401, self.send_error_json(401, "missing or invalid API key"))
+            return
+        try:
+            payload = json.loads(body)
+            prompts = payload["text_prompts"]
+            samples = int(payload.get("samples", 1))
+            seed = int(payload.get("seed") or 0)
+            if not prompts or samples < 1:
+                raise ValueError("text_prompts and samples are required")
+        except (ValueError, KeyError, TypeError) as e:
+            server.finish(400, self.send_error_json(400, f"invalid payload: {e}"))
+            return
+
+        status, latency = server.admit()
+        headers = {}
+        if status in (429, 503) and server.retry_after is not None:
+            headers["Retry-After"] = f"{server.retry_after:g}"
+        if status != 200:
+            server.finish(status, self.send_error_json(status, "injected failure", headers))
+            return
+
+        sent = 0
+        try:
+            time.sleep(latency)
+            artifacts = b",".join(
+                b'{"base64":"' + server.images[(seed + i) % len(server.images)]
+                + b'","seed":' + str(seed + i).encode() + b',"finishReason":"SUCCESS"}'
+                for i in range(samples)
+            )
+            sent = self.send_body(200, b'{"artifacts":[' + artifacts + b"]}")
+        finally:
+            server.finish(200, sent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local mock of the Stability text-to-image API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (0 picks a free one)")
+    parser.add_argument("--latency", default="lognormal:1.0,0.4",
+                        help="Response latency: fixed:S, uniform:LO,HI, exponential:MEAN "
+                             "or lognormal:MEDIAN,SIGMA (seconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a random 500/502/503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=None,
+                        help="Retry-After seconds sent with 429 and 503 responses")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="Answer 429 to requests beyond this many in flight")
+    parser.add_argument("--image-size", type=int, default=1024,
+                        help="Width and height of the returned PNGs (about 3 bytes per pixel)")
+    parser.add_argument("--api-key", default=None, help="Require this bearer token")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for latency and failure draws")
+    args = parser.parse_args()
+
+    server = MockStabilityServer(
+        (args.host, args.port), latency=args.latency, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        max_concurrency=args.max_concurrency, image_size=args.image_size,
+        api_key=args.api_key, seed=args.seed
+    )
+    print(f"Mock Stability API listening on {server.url}", flush=True)
+    print(f"Point the generators at it with STABILITY_API_HOST={server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,16 @@
-import json
 import random
-from typing import Dict, List, Union
+from typing import Dict, Iterable, Iterator, List, Sequence, Union
 import os
+from trait_sampler import TraitSampler, STREAM_CHUNK_SIZE
+from collection import Collection, TokenView
+from metadata_writer import BulkMetadataWriter
+from metadata_store import PackedMetadataStore
+from metadata_catalog import MetadataCatalog
+from config import TRAIT_RARITY, JOINT_QUOTAS
 
 class NFTTraitGenerator:
-    def __init__(self):
+    def __init__(self, seed: int = None, unique: bool = False, rarity: Dict = None,
+                 joint_quotas: Dict = None, rules: List[Dict] = None):
         # Collection info
         self.collection_name = "Pixel Heroes"
         self.base_url = "https://pixelheroes.io"
@@ -98,40 +104,52 @@ class NFTTraitGenerator:
             "Dexterity": (1, 99),
             "Luck": (1, 99)
         }
+        
+        # Trait columns in draw order, shared by the scalar and batch paths.
+        # With unique=True no two tokens share the same combination of them.
+        # `rarity`, `joint_quotas` and `rules` follow config.TRAIT_RARITY,
+        # config.JOINT_QUOTAS and config.TRAIT_RULES. Rules may extend a
+        # column with "None", so the columns are read back from the sampler
+        self.trait_columns = {
+            trait_type: self.traits[trait_type]
+            for trait_type in ["Base", "Name", "Hair Color", "Eyes", "Expression",
+                               "Background", "Special Effect"]
+        }
+        self.sampler = TraitSampler(
+            self.trait_columns, self.stat_ranges, len(self.description_templates),
+            seed=seed, unique=unique, rarity=rarity, joint_quotas=joint_quotas, rules=rules
+        )
+        self.trait_columns = self.sampler.columns
 
-    def generate_name(self, base: str, traits: Dict) -> str:
-        """Generate a name from the predefined list"""
-        # Simply use a name from the predefined list
-        return random.choice(self.traits["Name"])
-
-    def generate_description(self, traits: Dict) -> str:
+    def generate_description(self, traits: Dict, template: str = None) -> str:
         """Generate a description based on traits"""
         base_type = traits["Base"]  # Get character type (e.g., "Warrior")
         name = traits["Name"]  # Get character name
-        template = random.choice(self.description_templates)
+        if template is None:
+            template = random.choice(self.description_templates)
         
         return template.format(
             base=base_type.lower(),
             name=name,
-            hair_color=traits["Hair Color"].lower(),
+            hair_color=traits["Hair Color"].lower() if traits["Hair Color"] != "None" else "no",
             eyes=traits["Eyes"].lower(),
             expression=traits["Expression"].lower(),
             special_trait=self.special_traits.get(base_type, "A truly unique character!")
         )
 
     def generate_random_traits(self, token_id: int) -> Dict:
-        # Select base character type
-        base = random.choice(self.traits["Base"])
-        
-        # Get character name
-        name = self.generate_name(base, {})
-        
-        # Get trait values
-        hair_color = random.choice(self.traits["Hair Color"])
-        eyes = random.choice(self.traits["Eyes"])
-        expression = random.choice(self.traits["Expression"])
-        background = random.choice(self.traits["Background"])
-        special_effect = random.choice(self.traits["Special Effect"])
+        return self.build_metadata(token_id, self.sampler.draw(token_id))
+
+    def build_metadata(self, token_id: int, codes: Dict[str, int]) -> Dict:
+        """Build the metadata dict for a token from its sampled codes"""
+        # Resolve trait values
+        base = self.trait_columns["Base"][codes["Base"]]
+        name = self.trait_columns["Name"][codes["Name"]]
+        hair_color = self.trait_columns["Hair Color"][codes["Hair Color"]]
+        eyes = self.trait_columns["Eyes"][codes["Eyes"]]
+        expression = self.trait_columns["Expression"][codes["Expression"]]
+        background = self.trait_columns["Background"][codes["Background"]]
+        special_effect = self.trait_columns["Special Effect"][codes["Special Effect"]]
         
         # Create traits dict for description generation
         trait_dict = {
@@ -141,6 +159,7 @@ class NFTTraitGenerator:
             "Eyes": eyes,
             "Expression": expression
         }
+        template = self.description_templates[codes[TraitSampler.TEMPLATE]]
         
         # Generate character caption
         caption = ""
@@ -182,7 +201,7 @@ class NFTTraitGenerator:
         # Generate metadata
         metadata = {
             "name": f"{name}",
-            "description": self.generate_description(trait_dict),
+            "description": self.generate_description(trait_dict, template),
             "external_url": f"{self.base_url}/{token_id}",
             "image": f"{self.image_base_url}/{token_id}.png",
             "attributes": [
@@ -207,71 +226,96 @@ class NFTTraitGenerator:
                 })
         
         # Add RPG stats
-        metadata["attributes"].extend([
-            {
-                "display_type": "number",
-                "trait_type": "Level",
-                "value": random.randint(*self.stat_ranges["Level"])
-            },
-            {
-                "display_type": "number",
-                "trait_type": "HP",
-                "value": random.randint(*self.stat_ranges["HP"])
-            },
-            {
-                "display_type": "number",
-                "trait_type": "MP",
-                "value": random.randint(*self.stat_ranges["MP"])
-            },
-            {
-                "display_type": "number",
-                "trait_type": "Strength",
-                "value": random.randint(*self.stat_ranges["Strength"])
-            },
-            {
+        for stat_name in self.stat_ranges:
+            metadata["attributes"].append({
                 "display_type": "number",
-                "trait_type": "Intelligence",
-                "value": random.randint(*self.stat_ranges["Intelligence"])
-            },
-            {
-                "display_type": "number",
-                "trait_type": "Dexterity",
-                "value": random.randint(*self.stat_ranges["Dexterity"])
-            },
-            {
-                "display_type": "number",
-                "trait_type": "Luck",
-                "value": random.randint(*self.stat_ranges["Luck"])
-            }
-        ])
+                "trait_type": stat_name,
+                "value": codes[stat_name]
+            })
         
         return metadata
 
-    def generate_batch(self, start_id: int, count: int) -> List[Dict]:
-        """Generate multiple NFT metadata sets"""
-        return [self.generate_random_traits(i) for i in range(start_id, start_id + count)]
+    def generate_batch(self, start_id: int, count: int, quotas: bool = False) -> Collection:
+        """Generate multiple NFT metadata sets.
+        
+        All trait columns are sampled up front as NumPy arrays and returned as
+        a column-wise Collection; a token's metadata dict is only built when
+        it is read. Each token's traits depend only on the seed and its
+        token_id, so any range can be generated on its own. With quotas=True
+        trait values are instead allocated to hit the configured rarity
+        exactly across the batch, which needs a generator without trait rules.
+        """
+        if quotas:
+            return self.batch_from_codes(start_id, self.sampler.allocate(start_id, count))
+        return self.batch_from_codes(start_id, self.sampler.sample(start_id, count))
 
-    def save_metadata(self, metadata: Union[Dict, List[Dict]], output_dir: str):
-        """Save metadata to JSON file(s)"""
-        os.makedirs(output_dir, exist_ok=True)
+    def batch_from_codes(self, start_id: int, codes: Dict) -> Collection:
+        """Wrap sampled code columns in a column-wise collection"""
+        return Collection(start_id, codes, self.trait_columns, self.build_metadata)
+
+    def iter_traits(self, start_id: int, count: int) -> Iterator[TokenView]:
+        """Yield token metadata one token at a time.
         
-        if isinstance(metadata, list):
-            # Save batch as individual files
-            for nft in metadata:
-                token_id = int(nft["image"].split("/")[-1].split(".")[0])
-                filename = os.path.join(output_dir, f"{token_id}.json")
-                with open(filename, 'w') as f:
-                    json.dump(nft, f, indent=2)
-        else:
+        Tokens are sampled in fixed-size chunks, so memory stays constant no
+        matter how large the range is. The records match generate_batch.
+        """
+        for chunk_start in range(start_id, start_id + count, STREAM_CHUNK_SIZE):
+            chunk_count = min(STREAM_CHUNK_SIZE, start_id + count - chunk_start)
+            yield from self.generate_batch(chunk_start, chunk_count)
+
+    def save_metadata(self, metadata: Union[Dict, Sequence[Dict], Collection], output_dir: str,
+                      **writer_options):
+        """Save metadata to JSON file(s)"""
+        if isinstance(metadata, dict):
             # Save single metadata
-            token_id = int(metadata["image"].split("/")[-1].split(".")[0])
-            filename = os.path.join(output_dir, f"{token_id}.json")
-            with open(filename, 'w') as f:
-                json.dump(metadata, f, indent=2)
+            metadata = [metadata]
+        self.save_metadata_stream(metadata, output_dir, **writer_options)
+
+    def save_metadata_stream(self, records: Iterable, output_dir: str, compact: bool = False,
+                             threads: int = 0, fsync_every: int = 0, fanout: int = None) -> int:
+        """Save metadata records as they arrive, returning how many were written.
+        
+        compact, threads, fsync_every and fanout configure the BulkMetadataWriter.
+        """
+        with BulkMetadataWriter(output_dir, compact=compact, threads=threads,
+                                fsync_every=fsync_every, fanout=fanout) as writer:
+            for nft in records:
+                writer.submit(self.record_token_id(nft), nft)
+        return writer.written
+
+    def save_metadata_packed(self, records: Iterable, store_path: str) -> int:
+        """Append metadata records to a packed metadata store, returning how many were written"""
+        saved = 0
+        with PackedMetadataStore(store_path, mode="a") as store:
+            for nft in records:
+                store.append(*self.file_record(nft))
+                saved += 1
+        return saved
+
+    def save_metadata_catalog(self, records: Iterable, catalog_path: str) -> int:
+        """Insert metadata records into a SQLite metadata catalog, returning how many were written"""
+        saved = 0
+        with MetadataCatalog(catalog_path, list(self.trait_columns), list(self.stat_ranges)) as catalog:
+            for nft in records:
+                catalog.add(*self.file_record(nft))
+                saved += 1
+        return saved
+
+    def record_token_id(self, nft) -> int:
+        if isinstance(nft, TokenView):
+            # Token ids come straight from the collection's range
+            return nft.token_id
+        return int(nft["image"].split("/")[-1].split(".")[0])
+
+    def file_record(self, nft):
+        """Return (token_id, metadata) as it is stored on disk"""
+        metadata = nft.to_dict() if isinstance(nft, TokenView) else nft
+        return self.record_token_id(nft), metadata
 
 def main():
-    # Create generator
-    generator = NFTTraitGenerator()
+    # Create generator; the batch below uses quota allocation, which
+    # cannot be combined with config.TRAIT_RULES
+    generator = NFTTraitGenerator(rarity=TRAIT_RARITY, joint_quotas=JOINT_QUOTAS)
     
     # Create output directory
     output_dir = "metadata"
@@ -283,7 +327,7 @@ def main():
     
     # Generate a batch of NFT metadata
     batch_size = 333
-    batch_nfts = generator.generate_batch(2, batch_size)
+    batch_nfts = generator.generate_batch(2, batch_size, quotas=True)
     generator.save_metadata(batch_nfts, output_dir)
     
     print(f"Generated metadata for 1 single NFT and {batch_size} batch NFTs")
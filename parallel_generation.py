@@ -0,0 +1,115 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+from collection import Collection
+from metadata_catalog import MetadataCatalog
+from metadata_store import PackedMetadataStore, encode_records
+from token_layout import TokenLayout
+
+# Upper bound on tokens per shard; smaller ranges are split so every worker
+# gets several shards to balance load
+MAX_SHARD_SIZE = 10000
+
+# Generator instance installed in each worker process by _init_worker
+_worker_generator = None
+
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _generate_shard(shard: Tuple[int, int, str, Dict]):
+    """Sample, format and save one shard; only the code columns travel back"""
+    start_id, count, output_dir, write_options = shard
+    batch = _worker_generator.generate_batch(start_id, count)
+    _worker_generator.save_metadata(batch, output_dir, **write_options)
+    return start_id, batch.codes
+
+
+def _encode_shard(shard: Tuple[int, int]):
+    """Sample and serialize one shard for the parent to append to a packed store"""
+    start_id, count = shard
+    batch = _worker_generator.generate_batch(start_id, count)
+    blob, lengths = encode_records([_worker_generator.file_record(view)[1] for view in batch])
+    return start_id, batch.codes, blob, lengths
+
+
+def split_range(start_id: int, count: int, workers: int) -> List[Tuple[int, int]]:
+    """Split a token range into (start_id, count) shards"""
+    shard_size = max(1, min(MAX_SHARD_SIZE, -(-count // (workers * 4))))
+    return [
+        (shard_start, min(shard_size, start_id + count - shard_start))
+        for shard_start in range(start_id, start_id + count, shard_size)
+    ]
+
+
+def generate_sharded(generator, start_id: int, count: int, output_dir: str,
+                     workers: int, write_options: Dict = None) -> Iterator[Collection]:
+    """Generate and save metadata for a token range in a process pool.
+
+    Trait sampling, description formatting and JSON writing run in the
+    workers. Shards are yielded back in token order as collections, and
+    since every token's traits depend only on the seed and its token_id the
+    output matches a single-process run. `write_options` are passed on to
+    the generator's save_metadata in every worker.
+    """
+    if generator.sampler.index is not None:
+        raise ValueError("Unique mode tracks combinations across tokens and needs a single process")
+
+    # Record the layout once up front rather than from every worker
+    TokenLayout(output_dir, ".json", (write_options or {}).get("fanout")).prepare()
+    shards = [(shard_start, shard_count, output_dir, write_options or {})
+              for shard_start, shard_count in split_range(start_id, count, workers)]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(generator,)) as pool:
+        for shard_start, codes in pool.map(_generate_shard, shards):
+            yield generator.batch_from_codes(shard_start, codes)
+
+
+def generate_sharded_packed(generator, start_id: int, count: int, store_path: str,
+                            workers: int) -> Iterator[Collection]:
+    """Generate metadata in a process pool into a packed metadata store.
+
+    Workers sample and serialize their shards; the parent appends the
+    serialized records to the store in token order, since a packed store
+    has a single writer.
+    """
+    if generator.sampler.index is not None:
+        raise ValueError("Unique mode tracks combinations across tokens and needs a single process")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(generator,)) as pool, \
+            PackedMetadataStore(store_path, mode="a") as store:
+        for shard_start, codes, blob, lengths in pool.map(_encode_shard,
+                                                          split_range(start_id, count, workers)):
+            store.append_encoded(shard_start, blob, lengths)
+            yield generator.batch_from_codes(shard_start, codes)
+
+
+def generate_sharded_catalog(generator, start_id: int, count: int, catalog_path: str,
+                             workers: int) -> Iterator[Collection]:
+    """Generate metadata in a process pool into a SQLite metadata catalog.
+
+    Workers sample and serialize their shards; the parent fills the trait
+    and stat columns straight from each shard's code columns and inserts
+    the shard as one transaction.
+    """
+    if generator.sampler.index is not None:
+        raise ValueError("Unique mode tracks combinations across tokens and needs a single process")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(generator,)) as pool, \
+            MetadataCatalog(catalog_path, list(generator.trait_columns),
+                            list(generator.stat_ranges)) as catalog:
+        for shard_start, codes, blob, lengths in pool.map(_encode_shard,
+                                                          split_range(start_id, count, workers)):
+            batch = generator.batch_from_codes(shard_start, codes)
+            records, offset = [], 0
+            for length in lengths:
+                records.append(blob[offset:offset + length].decode("utf-8"))
+                offset += length
+            columns = [batch.values(name) for name in catalog.trait_types + catalog.stat_names]
+            catalog.add_rows(zip(batch.token_ids, *columns, records))
+            yield batch
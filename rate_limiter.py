@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Request outcomes reported to RateLimiter.release
+OUTCOME_OK = "ok"
+OUTCOME_THROTTLED = "throttled"  # 429/503: the server wants us to slow down
+OUTCOME_ERROR = "error"  # Anything else; leaves the concurrency limit alone
+
+# Window over which the achieved request rate is measured
+RATE_WINDOW = 10.0
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """Token bucket plus AIMD concurrency limit shared by every request thread.
+
+    `acquire` blocks until a request may start: fewer requests are in flight
+    than the current concurrency limit, the token bucket (refilled at `rate`
+    requests per second, holding up to `burst`) has a token, and no
+    Retry-After pause is active. `release` reports the outcome. Successes
+    raise the limit additively by about one request per round of `limit`
+    completions; throttled responses halve it, at most once per
+    `decrease_interval` so one burst of 429s counts as a single signal.
+
+    With max_concurrency=None the budget is whatever the caller sets with
+    `set_budget` (the number of worker threads), and with rate=None only
+    the concurrency limit applies.
+    """
+
+    def __init__(self, rate=None, burst=None, max_concurrency=None, min_concurrency=1,
+                 decrease=0.5, decrease_interval=1.0):
+        self.rate = rate
+        self.burst = burst if burst is not None else 1.0
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.decrease = decrease
+        self.decrease_interval = decrease_interval
+        self.limit = float(max_concurrency or min_concurrency)
+
+        self._explicit_budget = max_concurrency is not None
+        self._cond = threading.Condition()
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._decreased_at = float("-inf")
+        self._started = deque()
+        self._first_started = None
+        self.in_flight = 0
+        self.completed = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def set_budget(self, concurrency):
+        """Use the caller's worker count as the concurrency budget unless one was configured"""
+        with self._cond:
+            if self._explicit_budget:
+                return
+            self.max_concurrency = concurrency
+            self.limit = float(concurrency)
+            self._cond.notify_all()
+
+    def _refill(self, now):
+        if self.rate is None:
+            return
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _trim_started(self, now):
+        # Only starts within the rate window are kept, so memory stays bounded
+        while self._started and self._started[0] < now - RATE_WINDOW:
+            self._started.popleft()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.in_flight >= int(self.limit):
+                    # Woken by release
+                    wait = None
+                elif self.rate is not None and self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    break
+                self._cond.wait(wait)
+
+            if self.rate is not None:
+                self._tokens -= 1
+            self.in_flight += 1
+            self._started.append(now)
+            self._trim_started(now)
+            if self._first_started is None:
+                self._first_started = now
+
+    def release(self, outcome, retry_after=None):
+        """Report how a request acquired with `acquire` ended"""
+        with self._cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if outcome == OUTCOME_OK:
+                self.completed += 1
+                # Additive increase: about +1 per `limit` successes
+                self.limit = min(self.max_concurrency or self.limit, self.limit + 1.0 / self.limit)
+            elif outcome == OUTCOME_THROTTLED:
+                self.throttled += 1
+                if now - self._decreased_at >= self.decrease_interval:
+                    # Multiplicative decrease
+                    self.limit = max(self.min_concurrency, self.limit * self.decrease)
+                    self._decreased_at = now
+                if retry_after is not None:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            else:
+                self.errors += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """Live counters and how close the achieved rate is to the configured limit"""
+        with self._cond:
+            now = time.monotonic()
+            self._trim_started(now)
+            # Shorter runs are measured over the time since the first request
+            window = min(RATE_WINDOW, now - self._first_started) if self._first_started else 0
+            achieved = len(self._started) / window if window > 0 else 0.0
+            return {
+                "requests_per_second": achieved,
+                "rate_limit": self.rate,
+                "rate_utilization": achieved / self.rate if self.rate else None,
+                "concurrency_limit": self.limit,
+                "max_concurrency": self.max_concurrency,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "throttled": self.throttled,
+                "errors": self.errors,
+                "paused_for": max(0.0, self._paused_until - now),
+            }
+
+    def format_stats(self):
+        stats = self.stats()
+        rate = f"{stats['requests_per_second']:.2f} req/s"
+        if stats["rate_limit"]:
+            rate += f" of {stats['rate_limit']:g} ({stats['rate_utilization']:.0%})"
+        line = (
+            f"{rate}, concurrency {stats['in_flight']}/{stats['concurrency_limit']:.1f}"
+            f" (max {stats['max_concurrency']}), {stats['completed']} ok,"
+            f" {stats['throttled']} throttled, {stats['errors']} errors"
+        )
+        if stats["paused_for"]:
+            line += f", paused {stats['paused_for']:.1f}s (Retry-After)"
+        return line
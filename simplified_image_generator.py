@@ -1,14 +1,43 @@
+import asyncio
 import json
 import os
-from generate_pfp import PFPGenerator
+from generate_pfp import PFPGenerator, format_call_report
+from image_cache import DEFAULT_CACHE_DIR
+from layer_renderer import LayerRenderer, DEFAULT_LAYERS_DIR
+from metadata_store import PackedMetadataStore
+from metadata_catalog import MetadataCatalog
+from token_layout import TokenLayout
 from config import BASE_PROMPTS, CHARACTER_TYPES, COMMON_TRAITS
 
 class SimplifiedImageGenerator:
-    def __init__(self, style="pixel_rpg"):
-        self.generator = PFPGenerator()
+    def __init__(self, style="pixel_rpg", fanout=None, concurrency=1, rate_limit=None,
+                 use_cache=True, coalesce=True, variants=1, backend="api",
+                 layers_dir=DEFAULT_LAYERS_DIR, render_workers=None, layer_scale=1):
+        if backend not in ("api", "layers"):
+            raise ValueError(f"Unknown image backend {backend!r}")
+        # backend="api" generates each image with the Stability API; rate_limit
+        # caps requests per second (see RateLimiter), and with use_cache
+        # repeated requests are served from the image cache
+        self.generator = PFPGenerator(
+            rate_limit=rate_limit, cache_dir=DEFAULT_CACHE_DIR if use_cache else None
+        ) if backend == "api" else None
+        # backend="layers" composites local per-trait PNG layers instead
+        # (see LayerRenderer), in render_workers processes
+        self.renderer = LayerRenderer(layers_dir, scale=layer_scale) if backend == "layers" else None
+        self.render_workers = render_workers
+        # Number of image requests kept in flight by generate_images
+        self.concurrency = concurrency
+        # Tokens whose requests are identical share one API call
+        self.coalesce = coalesce
+        # Candidate images requested per token in a single call; each is kept
+        # as <token_id>_<i>.png with its seed in <token_id>.variants.json
+        self.variants = variants
         self.style = style
         self.base_prompt = BASE_PROMPTS[style]["prompt"]
         self.negative_prompt = BASE_PROMPTS[style]["negative_prompt"]
+        # Directory fanout of the image trees written (see TokenLayout)
+        self.fanout = fanout
+        self.layouts = {}
     
     def set_style(self, style):
         """Change the base prompt style"""
@@ -53,8 +82,8 @@ class SimplifiedImageGenerator:
         if name:
             prompt_parts.append(f"named {name}")
         
-        # Add hair color if present
-        if hair_color:
+        # Add hair color if present and not 'None'
+        if hair_color and hair_color != "None":
             prompt_parts.append(f"{hair_color.lower()} hair")
         
         # Add eyes if present
@@ -85,43 +114,135 @@ class SimplifiedImageGenerator:
         return prompt
     
     def generate_from_metadata_files(self, metadata_dir, output_dir):
-        """Generate images from individual metadata JSON files"""
+        """Generate images from individual metadata JSON files, a packed store or a catalog"""
         # Ensure output directory exists
         os.makedirs(output_dir, exist_ok=True)
         
-        # Get all JSON files in the metadata directory
-        metadata_files = [f for f in os.listdir(metadata_dir) if f.endswith('.json')]
+        if PackedMetadataStore.is_store(metadata_dir):
+            with PackedMetadataStore(metadata_dir) as store:
+                return self.generate_images(
+                    ((token_id, metadata["attributes"]) for token_id, metadata in store), output_dir
+                )
+        if MetadataCatalog.is_catalog(metadata_dir):
+            return self.generate_from_catalog(metadata_dir, output_dir)
+        
+        # List metadata files in token order, from the manifest when fanned out
+        layout = TokenLayout(metadata_dir, ".json")
+        
+        def tokens():
+            for token_id in layout.token_ids():
+                # Load metadata
+                with open(layout.path(token_id), 'r') as f:
+                    metadata = json.load(f)
+                yield token_id, metadata["attributes"]
+        
+        return self.generate_images(tokens(), output_dir)
+    
+    def generate_from_catalog(self, catalog_path, output_dir, traits=None, where=None, params=()):
+        """Generate images for the tokens a metadata catalog query selects"""
+        os.makedirs(output_dir, exist_ok=True)
         
-        for file_name in sorted(metadata_files, key=lambda x: int(x.split('.')[0])):
-            token_id = int(file_name.split('.')[0])
-            file_path = os.path.join(metadata_dir, file_name)
-            
-            # Load metadata
-            with open(file_path, 'r') as f:
-                metadata = json.load(f)
-            
-            print(f"\nProcessing NFT #{token_id}...")
-            
-            # Get character type for logging
-            character_type = next((attr["value"] for attr in metadata["attributes"] 
-                                if attr["trait_type"] == "Base"), "Unknown")
-            print(f"Character: {character_type}")
-            
-            # Generate prompt from traits
-            prompt = self.traits_to_prompt(metadata["attributes"])
-            
-            # Generate image
-            output_path = self.generator.generate_image(
-                prompt=prompt,
-                negative_prompt=self.negative_prompt,
-                seed=None  # Random seed
+        with MetadataCatalog(catalog_path) as catalog:
+            return self.generate_images(
+                ((token_id, metadata["attributes"])
+                 for token_id, metadata in catalog.select(traits, where, params)),
+                output_dir
             )
+    
+    def generate_from_collection(self, collection, output_dir):
+        """Generate images straight from a Collection, without metadata files"""
+        os.makedirs(output_dir, exist_ok=True)
+        
+        return self.generate_images(
+            ((view.token_id, view["attributes"]) for view in collection), output_dir
+        )
+    
+    def generate_images(self, tokens, output_dir):
+        """Generate images for (token_id, attributes) pairs.
+        
+        With concurrency > 1 up to that many API requests run at once and
+        each image is written to its token path as soon as it arrives.
+        With coalescing on, tokens whose requests are identical share one
+        API call and the image is linked to each of them. Otherwise tokens
+        are generated one at a time. Returns token_id -> GenerationResult,
+        so callers can see which tokens failed and why. With the layers
+        backend tokens are rendered locally in a process pool instead.
+        """
+        if self.renderer is not None:
+            layout = self.image_layout(output_dir)
             
-            if output_path:
-                # Copy to the NFT images directory with the token ID as filename
-                output_file = os.path.join(output_dir, f"{token_id}.png")
-                
-                # Use the returned path from generate_image
-                import shutil
-                shutil.copy(output_path, output_file)
-                print(f"Generated image saved as {output_file}")
+            def rendered(token_id, result):
+                if result.ok:
+                    layout.record([token_id])
+                else:
+                    print(f"Failed to render image for NFT #{token_id}: {result.error}")
+            
+            return self.renderer.render_tokens(tokens, layout, self.render_workers, on_result=rendered)
+        
+        if self.concurrency <= 1 and not self.coalesce:
+            results = {}
+            for token_id, attributes in tokens:
+                results[token_id] = self.generate_token_image(token_id, attributes, output_dir)
+            return results
+        
+        layout = self.image_layout(output_dir)
+        jobs = (
+            (token_id, self.traits_to_prompt(attributes), self.negative_prompt, None)
+            for token_id, attributes in tokens
+        )
+        
+        def saved(token_id, result):
+            if result.ok:
+                layout.record([token_id])
+                print(f"Generated image saved as {result.path}")
+            else:
+                print(f"Failed to generate image for NFT #{token_id}: {result.status} ({result.error})")
+        
+        results = asyncio.run(self.generator.generate_images_async(
+            jobs, max(1, self.concurrency), output_path=layout.output_path, on_result=saved,
+            stats_interval=30, coalesce=self.coalesce, samples=self.variants
+        ))
+        print(format_call_report(results))
+        return results
+    
+    def image_layout(self, output_dir):
+        """Layout of the per-token images under output_dir"""
+        if output_dir not in self.layouts:
+            layout = TokenLayout(output_dir, ".png", self.fanout)
+            layout.prepare()
+            self.layouts[output_dir] = layout
+        return self.layouts[output_dir]
+    
+    def generate_token_image(self, token_id, attributes, output_dir):
+        """Generate the image for one token from its attributes with the API, returning its GenerationResult.
+        The layers backend renders in batches in generate_images instead.
+        """
+        print(f"\nProcessing NFT #{token_id}...")
+        
+        # Get character type for logging
+        character_type = next((attr["value"] for attr in attributes 
+                            if attr["trait_type"] == "Base"), "Unknown")
+        print(f"Character: {character_type}")
+        
+        # Generate prompt from traits
+        prompt = self.traits_to_prompt(attributes)
+        
+        # Generate the image straight into its token path
+        layout = self.image_layout(output_dir)
+        output_file = layout.output_path(token_id)
+        result_path = self.generator.generate_image(
+            prompt=prompt,
+            negative_prompt=self.negative_prompt,
+            seed=None,  # Random seed
+            output_file=output_file,
+            samples=self.variants
+        )
+        
+        result = self.generator.last_result
+        if result_path:
+            layout.record([token_id])
+            print(f"Generated image saved as {output_file}")
+            return result
+        
+        print(f"Failed to generate image for NFT #{token_id}: {result.status} ({result.error})")
+        return result
@@ -3,43 +3,135 @@ import time
 import argparse
 from simplified_trait_generator import SimplifiedTraitGenerator
 from simplified_image_generator import SimplifiedImageGenerator
+from generate_pfp import failed_tokens
+from layer_renderer import DEFAULT_LAYERS_DIR
+from image_postprocess import DEFAULT_COLORS, post_process_images
+from image_derivatives import DEFAULT_SIZES, generate_derivatives
 from compile_metadata_csv import compile_metadata_to_csv
+from config import TRAIT_RULES
+from parallel_generation import (
+    generate_sharded, generate_sharded_packed, generate_sharded_catalog
+)
 
 class SimplifiedNFTGenerator:
-    def __init__(self, style="pixel_rpg"):
-        self.trait_generator = SimplifiedTraitGenerator()
-        self.image_generator = SimplifiedImageGenerator(style=style)
+    def __init__(self, style="pixel_rpg", packed=False, catalog=False, fanout=None,
+                 image_concurrency=1, rate_limit=None, use_cache=True, coalesce=True,
+                 image_variants=1, image_backend="api", layers_dir=DEFAULT_LAYERS_DIR,
+                 render_workers=None, layer_scale=1, post_process=False,
+                 palette_colors=DEFAULT_COLORS, cell_size=None, derivative_sizes=None,
+                 seed=None):
+        # The same seed always gives the same traits
+        self.trait_generator = SimplifiedTraitGenerator(seed=seed, rules=TRAIT_RULES)
+        self.image_generator = SimplifiedImageGenerator(
+            style=style, fanout=fanout, concurrency=image_concurrency, rate_limit=rate_limit,
+            use_cache=use_cache, coalesce=coalesce, variants=image_variants,
+            backend=image_backend, layers_dir=layers_dir, render_workers=render_workers,
+            layer_scale=layer_scale
+        )
+        
+        # With packed=True metadata goes to a single packed store directory
+        # instead of one JSON file per token, with catalog=True to a SQLite
+        # metadata catalog
+        self.packed = packed
+        self.catalog = catalog
+        
+        # With post_process=True finished images are also shrunk to their
+        # native pixel grid with a palette_colors palette
+        self.post_process = post_process
+        self.palette_colors = palette_colors
+        self.cell_size = cell_size
+        self.render_workers = render_workers
+        
+        # With derivative_sizes thumbnails of those sizes are kept up to date
+        self.derivative_sizes = derivative_sizes
         
         # Create necessary directories
         self.directories = {
-            "metadata": "metadata",
+            "metadata": "metadata.catalog" if catalog else "metadata.pack" if packed else "metadata",
             "images": "nft_images",
             "csv": "metadata_csv"
         }
+        if post_process:
+            self.directories["native"] = "nft_images_native"
+        if derivative_sizes:
+            self.directories["derivatives"] = "nft_images_derivatives"
         
         for dir_path in self.directories.values():
             os.makedirs(dir_path, exist_ok=True)
     
-    def generate_nfts(self, start_id=1, count=10):
-        """Generate NFTs with traits, metadata, and images"""
+    def generate_nfts(self, start_id=1, count=10, workers=1, write_options=None):
+        """Generate NFTs with traits, metadata, and images
+        
+        write_options (compact, threads, fsync_every, fanout) configure the metadata writer
+        and are ignored for a packed store or catalog.
+        """
+        write_options = write_options or {}
         print("\n=== Step 1: Generating NFT Traits and Metadata ===")
-        batch_nfts = self.trait_generator.generate_batch(start_id, count)
-        self.trait_generator.save_metadata(batch_nfts, self.directories["metadata"])
-        print(f"✓ Generated {count} NFT metadata files")
+        if self.catalog and workers > 1 and count > 0:
+            shards = generate_sharded_catalog(
+                self.trait_generator, start_id, count, self.directories["metadata"], workers
+            )
+            saved = sum(len(shard) for shard in shards)
+        elif self.catalog:
+            saved = self.trait_generator.save_metadata_catalog(
+                self.trait_generator.iter_traits(start_id, count),
+                self.directories["metadata"]
+            )
+        elif self.packed and workers > 1 and count > 0:
+            shards = generate_sharded_packed(
+                self.trait_generator, start_id, count, self.directories["metadata"], workers
+            )
+            saved = sum(len(shard) for shard in shards)
+        elif self.packed:
+            saved = self.trait_generator.save_metadata_packed(
+                self.trait_generator.iter_traits(start_id, count),
+                self.directories["metadata"]
+            )
+        elif workers > 1 and count > 0:
+            shards = generate_sharded(
+                self.trait_generator, start_id, count, self.directories["metadata"], workers,
+                write_options
+            )
+            saved = sum(len(shard) for shard in shards)
+        else:
+            saved = self.trait_generator.save_metadata_stream(
+                self.trait_generator.iter_traits(start_id, count),
+                self.directories["metadata"],
+                **write_options
+            )
+        print(f"✓ Generated {saved} NFT metadata files")
         
         print("\n=== Step 2: Generating NFT Images ===")
-        self.image_generator.generate_from_metadata_files(
+        results = self.image_generator.generate_from_metadata_files(
             self.directories["metadata"],
             self.directories["images"]
         )
-        print("✓ Generated NFT images")
+        failed = failed_tokens(results)
+        print(f"✓ Generated {len(results) - sum(map(len, failed.values()))} NFT images")
+        for status, token_ids in failed.items():
+            print(f"⚠ {len(token_ids)} images {status}: tokens {token_ids[:20]}"
+                  f"{' ...' if len(token_ids) > 20 else ''}")
+        
+        if self.post_process:
+            print("\n=== Post-processing NFT Images ===")
+            post_process_images(
+                self.directories["images"], self.directories["native"],
+                colors=self.palette_colors, cell_size=self.cell_size, workers=self.render_workers
+            )
+        
+        if self.derivative_sizes:
+            print("\n=== Building Image Thumbnails ===")
+            generate_derivatives(
+                self.directories["images"], self.directories["derivatives"],
+                sizes=self.derivative_sizes, workers=self.render_workers
+            )
         
         print("\n=== Step 3: Compiling Metadata CSV ===")
         output_file = os.path.join(self.directories["csv"], "compiled_metadata.csv")
         compile_metadata_to_csv(self.directories["metadata"], output_file)
         print("✓ Compiled metadata CSV")
         
-        return batch_nfts
+        return saved
 
 def main():
     # Parse command line arguments
@@ -63,18 +155,162 @@ def main():
         default=1,
         help="Starting token ID"
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for the trait draws; the same seed gives the same collection"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to generate trait metadata"
+    )
+    parser.add_argument(
+        "--compact-json",
+        action="store_true",
+        help="Write metadata files without indentation"
+    )
+    parser.add_argument(
+        "--write-threads",
+        type=int,
+        default=0,
+        help="Number of threads used to serialize and write metadata files"
+    )
+    parser.add_argument(
+        "--fsync-every",
+        type=int,
+        default=0,
+        help="Fsync written metadata files in groups of this size (0 disables fsync)"
+    )
+    parser.add_argument(
+        "--packed",
+        action="store_true",
+        help="Store metadata in a single packed store instead of one JSON file per token"
+    )
+    parser.add_argument(
+        "--catalog",
+        action="store_true",
+        help="Store metadata in a SQLite catalog with indexed trait columns"
+    )
+    parser.add_argument(
+        "--fanout",
+        type=int,
+        default=None,
+        help="Nest per-token metadata and image files this many directory levels deep "
+             "(default: keep the existing layout, flat for new directories)"
+    )
+    parser.add_argument(
+        "--image-concurrency",
+        type=int,
+        default=1,
+        help="Number of image generation requests kept in flight"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=None,
+        help="Maximum image generation requests per second (default: no limit)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call the image API instead of reusing cached images for identical requests"
+    )
+    parser.add_argument(
+        "--no-coalesce",
+        action="store_true",
+        help="Send one image request per token even when several tokens' requests are identical"
+    )
+    parser.add_argument(
+        "--variants",
+        type=int,
+        default=1,
+        help="Candidate images requested per token in one API call, saved as <token_id>_<i>.png"
+    )
+    parser.add_argument(
+        "--image-backend",
+        choices=["api", "layers"],
+        default="api",
+        help="Generate images with the Stability API or composite local trait layers"
+    )
+    parser.add_argument(
+        "--layers-dir",
+        default=DEFAULT_LAYERS_DIR,
+        help="Directory of <trait type>/<value>.png layers for the layers backend"
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=None,
+        help="Processes rendering layered or post-processing images (default: one per CPU)"
+    )
+    parser.add_argument(
+        "--layer-scale",
+        type=int,
+        default=1,
+        help="Upscale rendered layer images by this factor with nearest-neighbour resampling"
+    )
+    parser.add_argument(
+        "--post-process",
+        action="store_true",
+        help="Also write native-resolution palette PNGs of the images to nft_images_native/"
+    )
+    parser.add_argument(
+        "--palette-colors",
+        type=int,
+        default=DEFAULT_COLORS,
+        help="Palette size of post-processed images"
+    )
+    parser.add_argument(
+        "--cell-size",
+        type=int,
+        default=None,
+        help="Source pixels per art pixel for post-processing (default: detect the grid)"
+    )
+    parser.add_argument(
+        "--derivatives",
+        type=int,
+        nargs="*",
+        default=None,
+        help="Also build thumbnails with these longest sides in nft_images_derivatives/ "
+             f"(no sizes: {' '.join(map(str, DEFAULT_SIZES))})"
+    )
     
     args = parser.parse_args()
     
+    # --derivatives without sizes builds the default ones
+    derivative_sizes = args.derivatives
+    if derivative_sizes is not None and not derivative_sizes:
+        derivative_sizes = DEFAULT_SIZES
+    
     # Initialize the generator with the specified style
-    generator = SimplifiedNFTGenerator(style=args.style)
+    generator = SimplifiedNFTGenerator(
+        style=args.style, packed=args.packed, catalog=args.catalog, fanout=args.fanout,
+        image_concurrency=args.image_concurrency, rate_limit=args.rate_limit,
+        use_cache=not args.no_cache, coalesce=not args.no_coalesce,
+        image_variants=args.variants, image_backend=args.image_backend,
+        layers_dir=args.layers_dir, render_workers=args.render_workers,
+        layer_scale=args.layer_scale, post_process=args.post_process,
+        palette_colors=args.palette_colors, cell_size=args.cell_size,
+        derivative_sizes=derivative_sizes, seed=args.seed
+    )
     
     # Record start time
     start_time = time.time()
     
     try:
         # Generate NFTs
-        generator.generate_nfts(args.start_id, args.count)
+        write_options = {
+            "compact": args.compact_json,
+            "threads": args.write_threads,
+            "fsync_every": args.fsync_every,
+            "fanout": args.fanout
+        }
+        generator.generate_nfts(
+            args.start_id, args.count, workers=args.workers, write_options=write_options
+        )
         
         # Calculate total time
         total_time = time.time() - start_time
@@ -86,6 +322,10 @@ def main():
         print("\nOutput directories:")
         print(f"- Metadata: {generator.directories['metadata']}/")
         print(f"- Images: {generator.directories['images']}/")
+        if "native" in generator.directories:
+            print(f"- Native images: {generator.directories['native']}/")
+        if "derivatives" in generator.directories:
+            print(f"- Thumbnails: {generator.directories['derivatives']}/")
         print(f"- CSV: {generator.directories['csv']}/")
         
     except Exception as e:
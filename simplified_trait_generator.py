@@ -1,11 +1,18 @@
 import random
-import json
-import os
-from typing import Dict, List, Any
-from config import CHARACTER_TYPES, COMMON_TRAITS, RPG_STATS, DESCRIPTION_TEMPLATES
+from typing import Dict, List, Any, Iterable, Iterator, Sequence
+from config import (
+    CHARACTER_TYPES, COMMON_TRAITS, RPG_STATS, DESCRIPTION_TEMPLATES,
+    TRAIT_RARITY, JOINT_QUOTAS
+)
+from trait_sampler import TraitSampler, STREAM_CHUNK_SIZE
+from collection import Collection, TokenView
+from metadata_writer import BulkMetadataWriter
+from metadata_store import PackedMetadataStore
+from metadata_catalog import MetadataCatalog
 
 class SimplifiedTraitGenerator:
-    def __init__(self):
+    def __init__(self, seed: int = None, unique: bool = False, rarity: Dict = None,
+                 joint_quotas: Dict = None, rules: List[Dict] = None):
         # Collection info
         self.collection_name = "Pixel Heroes"
         self.base_url = "https://pixelheroes.io"
@@ -16,21 +23,35 @@ class SimplifiedTraitGenerator:
         self.common_traits = COMMON_TRAITS
         self.stat_ranges = RPG_STATS
         self.description_templates = DESCRIPTION_TEMPLATES
+        self.trait_rarity = TRAIT_RARITY if rarity is None else rarity
+        self.joint_quotas = JOINT_QUOTAS if joint_quotas is None else joint_quotas
+        # Rules are opt-in (e.g. rules=TRAIT_RULES), since quota allocation
+        # cannot honour them
+        self.trait_rules = rules
+        
+        # Trait columns in draw order, shared by the scalar and batch paths.
+        # With unique=True no two tokens share the same combination of them.
+        # Trait rules may extend a column with "None", so the columns are
+        # read back from the sampler
+        self.trait_columns = {"Base": list(self.character_types.keys()), **self.common_traits}
+        self.sampler = TraitSampler(
+            self.trait_columns, self.stat_ranges, len(self.description_templates),
+            seed=seed, unique=unique, rarity=self.trait_rarity, joint_quotas=self.joint_quotas,
+            rules=self.trait_rules
+        )
+        self.trait_columns = self.sampler.columns
     
-    def generate_name(self) -> str:
-        """Generate a name from the predefined list"""
-        return random.choice(self.common_traits["Name"])
-    
-    def generate_description(self, traits: Dict) -> str:
+    def generate_description(self, traits: Dict, template: str = None) -> str:
         """Generate a description based on traits"""
         base_type = traits["Base"]  # Get character type (e.g., "Warrior")
         name = traits["Name"]  # Get character name
-        template = random.choice(self.description_templates)
+        if template is None:
+            template = random.choice(self.description_templates)
         
         return template.format(
             base=base_type.lower(),
             name=name,
-            hair_color=traits["Hair Color"].lower(),
+            hair_color=traits["Hair Color"].lower() if traits["Hair Color"] != "None" else "no",
             eyes=traits["Eyes"].lower(),
             expression=traits["Expression"].lower(),
             special_trait=self.character_types[base_type]["special_trait"]
@@ -38,18 +59,18 @@ class SimplifiedTraitGenerator:
     
     def generate_random_traits(self, token_id: int) -> Dict:
         """Generate random traits for a character"""
-        # Select base character type
-        base = random.choice(list(self.character_types.keys()))
-        
-        # Get character name
-        name = self.generate_name()
-        
-        # Get trait values
-        hair_color = random.choice(self.common_traits["Hair Color"])
-        eyes = random.choice(self.common_traits["Eyes"])
-        expression = random.choice(self.common_traits["Expression"])
-        background = random.choice(self.common_traits["Background"])
-        special_effect = random.choice(self.common_traits["Special Effect"])
+        return self.build_metadata(token_id, self.sampler.draw(token_id))
+    
+    def build_metadata(self, token_id: int, codes: Dict[str, int]) -> Dict:
+        """Build the metadata dict for a token from its sampled codes"""
+        # Resolve trait values
+        base = self.trait_columns["Base"][codes["Base"]]
+        name = self.trait_columns["Name"][codes["Name"]]
+        hair_color = self.trait_columns["Hair Color"][codes["Hair Color"]]
+        eyes = self.trait_columns["Eyes"][codes["Eyes"]]
+        expression = self.trait_columns["Expression"][codes["Expression"]]
+        background = self.trait_columns["Background"][codes["Background"]]
+        special_effect = self.trait_columns["Special Effect"][codes["Special Effect"]]
         
         # Create traits dict for description generation
         trait_dict = {
@@ -59,6 +80,7 @@ class SimplifiedTraitGenerator:
             "Eyes": eyes,
             "Expression": expression
         }
+        template = self.description_templates[codes[TraitSampler.TEMPLATE]]
         
         # Get character description from config
         character_desc = self.character_types[base]["description"]
@@ -66,7 +88,7 @@ class SimplifiedTraitGenerator:
         # Generate metadata
         metadata = {
             "name": f"{name}",
-            "description": self.generate_description(trait_dict),
+            "description": self.generate_description(trait_dict, template),
             "external_url": f"{self.base_url}/{token_id}",
             "image": f"{self.image_base_url}/{token_id}.png",
             "attributes": [
@@ -91,36 +113,89 @@ class SimplifiedTraitGenerator:
                 })
         
         # Add RPG stats
-        for stat_name, stat_range in self.stat_ranges.items():
+        for stat_name in self.stat_ranges:
             metadata["attributes"].append({
                 "display_type": "number",
                 "trait_type": stat_name,
-                "value": random.randint(*stat_range)
+                "value": codes[stat_name]
             })
         
         return metadata
     
-    def generate_batch(self, start_id: int, count: int) -> List[Dict]:
-        """Generate a batch of NFT metadata"""
-        batch = []
-        for i in range(count):
-            token_id = start_id + i
-            metadata = self.generate_random_traits(token_id)
-            metadata["token_id"] = token_id
-            batch.append(metadata)
-        return batch
+    def _build_batch_item(self, token_id: int, codes: Dict[str, int]) -> Dict:
+        metadata = self.build_metadata(token_id, codes)
+        metadata["token_id"] = token_id
+        return metadata
+    
+    def generate_batch(self, start_id: int, count: int, quotas: bool = False) -> Collection:
+        """Generate a batch of NFT metadata.
+        
+        All trait columns are sampled up front as NumPy arrays and returned as
+        a column-wise Collection; a token's metadata dict is only built when
+        it is read. Each token's traits depend only on the seed and its
+        token_id, so any range can be generated on its own. With quotas=True
+        trait values are instead allocated to hit the configured rarity
+        exactly across the batch, which needs a generator without trait rules.
+        """
+        if quotas:
+            return self.batch_from_codes(start_id, self.sampler.allocate(start_id, count))
+        return self.batch_from_codes(start_id, self.sampler.sample(start_id, count))
+    
+    def batch_from_codes(self, start_id: int, codes: Dict) -> Collection:
+        """Wrap sampled code columns in a column-wise collection"""
+        return Collection(start_id, codes, self.trait_columns, self._build_batch_item)
+    
+    def iter_traits(self, start_id: int, count: int) -> Iterator[TokenView]:
+        """Yield token metadata one token at a time.
+        
+        Tokens are sampled in fixed-size chunks, so memory stays constant no
+        matter how large the range is. The records match generate_batch.
+        """
+        for chunk_start in range(start_id, start_id + count, STREAM_CHUNK_SIZE):
+            chunk_count = min(STREAM_CHUNK_SIZE, start_id + count - chunk_start)
+            yield from self.generate_batch(chunk_start, chunk_count)
     
-    def save_metadata(self, batch: List[Dict], output_dir: str) -> None:
+    def save_metadata(self, batch: Sequence, output_dir: str, **writer_options) -> None:
         """Save metadata to individual JSON files"""
-        os.makedirs(output_dir, exist_ok=True)
+        self.save_metadata_stream(batch, output_dir, **writer_options)
+    
+    def save_metadata_stream(self, records: Iterable, output_dir: str, compact: bool = False,
+                             threads: int = 0, fsync_every: int = 0, fanout: int = None) -> int:
+        """Save metadata records as they arrive, returning how many were written.
         
-        for item in batch:
-            token_id = item["token_id"]
-            file_path = os.path.join(output_dir, f"{token_id}.json")
-            
-            # Create a copy without the token_id field for the actual metadata file
-            metadata = item.copy()
-            metadata.pop("token_id", None)
-            
-            with open(file_path, "w") as f:
-                json.dump(metadata, f, indent=2)
+        compact, threads, fsync_every and fanout configure the BulkMetadataWriter.
+        """
+        # The token_id field is kept out of the actual metadata file
+        with BulkMetadataWriter(output_dir, compact=compact, threads=threads,
+                                fsync_every=fsync_every, drop_keys=("token_id",),
+                                fanout=fanout) as writer:
+            for item in records:
+                token_id = item.token_id if isinstance(item, TokenView) else item["token_id"]
+                writer.submit(token_id, item)
+        return writer.written
+    
+    def save_metadata_packed(self, records: Iterable, store_path: str) -> int:
+        """Append metadata records to a packed metadata store, returning how many were written"""
+        saved = 0
+        with PackedMetadataStore(store_path, mode="a") as store:
+            for item in records:
+                store.append(*self.file_record(item))
+                saved += 1
+        return saved
+    
+    def save_metadata_catalog(self, records: Iterable, catalog_path: str) -> int:
+        """Insert metadata records into a SQLite metadata catalog, returning how many were written"""
+        saved = 0
+        with MetadataCatalog(catalog_path, list(self.trait_columns), list(self.stat_ranges)) as catalog:
+            for item in records:
+                catalog.add(*self.file_record(item))
+                saved += 1
+        return saved
+    
+    def file_record(self, item):
+        """Return (token_id, metadata) as it is stored on disk, without the token_id field"""
+        if isinstance(item, TokenView):
+            item = item.to_dict()
+        metadata = item.copy()
+        token_id = metadata.pop("token_id")
+        return token_id, metadata
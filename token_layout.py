@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+from typing import Iterable, List
+
+import numpy as np
+
+LAYOUT_FILE = "layout.json"
+MANIFEST_FILE = "manifest.txt"
+
+# Tokens per leaf directory, and subdirectories per level below the top one
+FILES_PER_DIR = 100
+
+
+class TokenLayout:
+    """Resolves where each token's file lives under a root directory.
+
+    With fanout=0 files sit directly in the root as <token_id><extension>,
+    the original flat layout. With fanout=N tokens are bucketed by id into N
+    levels of nested directories holding at most 100 entries each, e.g.
+    token 1234 -> 00/12/1234.json for fanout=2, so no directory grows past
+    a few hundred entries however large the collection gets and adjacent
+    tokens share a directory.
+
+    A fanned-out root records its fanout in layout.json, so readers pick up
+    the layout from disk, and keeps a manifest of every token written so
+    listing tokens never needs a directory walk.
+    """
+
+    def __init__(self, root: str, extension: str, fanout: int = None):
+        self.root = root
+        self.extension = extension
+        on_disk = self.read_fanout(root)
+        if fanout is None:
+            fanout = on_disk if on_disk is not None else 0
+        elif on_disk is not None and on_disk != fanout:
+            raise ValueError(f"{root} already uses a directory fanout of {on_disk}, not {fanout}")
+        self.fanout = fanout
+        self._made = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def read_fanout(root: str):
+        """Fanout recorded in a root's layout file, or None for a flat or new root"""
+        path = os.path.join(root, LAYOUT_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)["fanout"]
+
+    def prepare(self) -> None:
+        """Create the root and, when fanned out, record the layout"""
+        os.makedirs(self.root, exist_ok=True)
+        if self.fanout and self.read_fanout(self.root) is None:
+            # Write then rename, so concurrent writers never see a partial file
+            tmp_path = os.path.join(self.root, f"{LAYOUT_FILE}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({"fanout": self.fanout}, f)
+            os.replace(tmp_path, os.path.join(self.root, LAYOUT_FILE))
+
+    def directory(self, token_id: int) -> str:
+        if not self.fanout:
+            return self.root
+        bucket = token_id // FILES_PER_DIR
+        parts = []
+        for _ in range(self.fanout - 1):
+            parts.append(f"{bucket % FILES_PER_DIR:02d}")
+            bucket //= FILES_PER_DIR
+        # The top level keeps counting past 99 for very large collections
+        parts.append(f"{bucket:02d}")
+        return os.path.join(self.root, *reversed(parts))
+
+    def path(self, token_id: int) -> str:
+        return os.path.join(self.directory(token_id), f"{token_id}{self.extension}")
+
+    def output_path(self, token_id: int) -> str:
+        """Path for writing a token's file, creating its directory on first use"""
+        directory = self.directory(token_id)
+        if directory not in self._made:
+            os.makedirs(directory, exist_ok=True)
+            self._made.add(directory)
+        return os.path.join(directory, f"{token_id}{self.extension}")
+
+    def record(self, token_ids: Iterable[int]) -> None:
+        """Append written tokens to the manifest of a fanned-out root"""
+        if not self.fanout:
+            return
+        data = "".join(f"{token_id}\n" for token_id in token_ids).encode("ascii")
+        if not data:
+            return
+        # One O_APPEND write per call keeps lines intact across worker processes
+        with self._lock:
+            fd = os.open(os.path.join(self.root, MANIFEST_FILE),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+    def token_ids(self) -> List[int]:
+        """Sorted ids of every token file, from the manifest when fanned out"""
+        if self.fanout:
+            manifest = os.path.join(self.root, MANIFEST_FILE)
+            if not os.path.isfile(manifest):
+                return []
+            with open(manifest) as f:
+                return np.unique(np.array(f.read().split(), dtype=np.int64)).tolist()
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            int(name[:-len(self.extension)]) for name in os.listdir(self.root)
+            if name.endswith(self.extension) and name[:-len(self.extension)].isdigit()
+        )
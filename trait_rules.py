@@ -0,0 +1,130 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Value given to a trait that a rule omits
+OMITTED = "None"
+
+
+def compile_rules(columns: Dict[str, List[str]], rules: List[Dict]
+                  ) -> Tuple[Dict[str, List[str]], Dict[Tuple[str, str], np.ndarray]]:
+    """Compile trait rules into pairwise exclusion matrices.
+
+    Every rule reduces to a set of value pairs that may never appear on the
+    same token. Since exclusions are symmetric they are keyed on the pair of
+    trait types in draw order: forbidden[(earlier, later)][a, b] is True when
+    value a of the earlier trait rules out value b of the later one. Traits
+    that can be omitted get an OMITTED value appended to their vocabulary,
+    so the returned columns may differ from the input.
+    """
+    columns = {trait_type: list(values) for trait_type, values in columns.items()}
+    order = list(columns)
+
+    # Omitted traits need a value to stand for "not present"
+    added = set()
+    for rule in rules:
+        for trait_type in rule.get("omit", []):
+            _check_trait(columns, trait_type)
+            if OMITTED not in columns[trait_type]:
+                columns[trait_type].append(OMITTED)
+                added.add(trait_type)
+
+    pairs = []
+    for rule in rules:
+        condition = rule.get("if", {})
+        if len(condition) != 1:
+            raise ValueError(f"Trait rule needs exactly one 'if' trait: {rule}")
+        (trait_type, values), = condition.items()
+        chosen = _codes(columns, trait_type, values)
+
+        for target, forbidden_values in rule.get("forbid", {}).items():
+            pairs.append((trait_type, chosen, target, _codes(columns, target, forbidden_values)))
+        for target, required_values in rule.get("require", {}).items():
+            required = set(_codes(columns, target, required_values))
+            rest = [code for code in range(len(columns[target])) if code not in required]
+            pairs.append((trait_type, chosen, target, rest))
+        for target in rule.get("omit", []):
+            omitted = columns[target].index(OMITTED)
+            rest = [code for code in range(len(columns[target])) if code != omitted]
+            pairs.append((trait_type, chosen, target, rest))
+            if target in added:
+                # A value that only exists for omission is never drawn otherwise
+                others = [code for code in range(len(columns[trait_type])) if code not in chosen]
+                pairs.append((trait_type, others, target, [omitted]))
+
+    forbidden = {}
+    for trait_type, codes, target, target_codes in pairs:
+        if trait_type == target:
+            raise ValueError(f"Trait rule refers to {trait_type} on both sides")
+        # Store under (earlier, later) so masks can be applied while drawing in order
+        if order.index(trait_type) > order.index(target):
+            trait_type, codes, target, target_codes = target, target_codes, trait_type, codes
+        key = (trait_type, target)
+        if key not in forbidden:
+            forbidden[key] = np.zeros((len(columns[trait_type]), len(columns[target])), dtype=bool)
+        forbidden[key][np.ix_(codes, target_codes)] = True
+
+    return columns, forbidden
+
+
+def count_combinations(columns: Dict[str, List[str]], forbidden: Dict[Tuple[str, str], np.ndarray],
+                       possible: Dict[str, np.ndarray]) -> int:
+    """Count the trait combinations that satisfy every rule.
+
+    Walks the traits in draw order, tracking the distinct sets of values
+    still allowed for the remaining traits, and raises ValueError if some
+    reachable choice leaves a later trait with nothing to draw. `possible`
+    marks the values with a non-zero probability.
+    """
+    order = list(columns)
+    # forbid_bits[j][v][k]: bitmask of trait k values ruled out by value v of trait j
+    forbid_bits = []
+    for j, trait_type in enumerate(order):
+        per_value = []
+        for value in range(len(columns[trait_type])):
+            masks = []
+            for later in order[j + 1:]:
+                matrix = forbidden.get((trait_type, later))
+                masks.append(_to_bits(matrix[value]) if matrix is not None else 0)
+            per_value.append(masks)
+        forbid_bits.append(per_value)
+
+    initial = tuple(_to_bits(possible[trait_type]) for trait_type in order)
+    # Distinct remaining-mask states, with the number of paths leading to
+    # each and one example path for error messages
+    states = {initial: (1, [])}
+    for j, trait_type in enumerate(order):
+        next_states = {}
+        for state, (paths, example) in states.items():
+            if state[0] == 0:
+                chosen = ", ".join(f"{order[k]}={columns[order[k]][v]}" for k, v in enumerate(example))
+                raise ValueError(f"Trait rules leave no possible {trait_type} for {chosen}")
+            for value in _bit_values(state[0]):
+                masks = forbid_bits[j][value]
+                new_state = tuple(mask & ~masks[k] for k, mask in enumerate(state[1:]))
+                count, path = next_states.get(new_state, (0, example + [value]))
+                next_states[new_state] = (count + paths, path)
+        states = next_states
+
+    return sum(paths for paths, _ in states.values())
+
+
+def _check_trait(columns: Dict[str, List[str]], trait_type: str) -> None:
+    if trait_type not in columns:
+        raise ValueError(f"Trait rule refers to unknown trait type: {trait_type}")
+
+
+def _codes(columns: Dict[str, List[str]], trait_type: str, values: List[str]) -> List[int]:
+    _check_trait(columns, trait_type)
+    unknown = [value for value in values if value not in columns[trait_type]]
+    if unknown:
+        raise ValueError(f"Trait rule refers to unknown {trait_type} values: {unknown}")
+    return [columns[trait_type].index(value) for value in values]
+
+
+def _to_bits(flags: np.ndarray) -> int:
+    return sum(1 << i for i in np.flatnonzero(flags).tolist())
+
+
+def _bit_values(mask: int) -> List[int]:
+    return [i for i in range(mask.bit_length()) if mask >> i & 1]
@@ -0,0 +1,508 @@
+import heapq
+import random
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from trait_rules import compile_rules, count_combinations
+
+# Combination spaces up to this many keys are tracked in a bitset (128 MB at
+# the limit); larger spaces fall back to a sorted array of seen keys
+BITSET_MAX_KEYS = 1 << 30
+
+# Tokens sampled at a time by the streaming generators; large enough to keep
+# the vectorized path efficient, small enough to keep memory flat
+STREAM_CHUNK_SIZE = 4096
+
+
+def trait_probabilities(values: List[str], percentages: Dict[str, float] = None) -> np.ndarray:
+    """Resolve per-value rarity percentages into a probability vector.
+
+    Values listed in `percentages` get that share of the draws and the
+    remaining values split what is left evenly. If every value is listed the
+    percentages are used as relative weights.
+    """
+    percentages = percentages or {}
+    unknown = set(percentages) - set(values)
+    if unknown:
+        raise ValueError(f"Rarity given for unknown trait values: {sorted(unknown)}")
+    if any(p < 0 for p in percentages.values()):
+        raise ValueError("Rarity percentages must not be negative")
+
+    unlisted = [value for value in values if value not in percentages]
+    listed_total = sum(percentages.values())
+    if unlisted:
+        if listed_total > 100:
+            raise ValueError(f"Rarity percentages add up to {listed_total}%, more than 100%")
+        share = (100 - listed_total) / len(unlisted)
+        weights = np.array([percentages.get(value, share) for value in values], dtype=np.float64)
+    else:
+        weights = np.array([percentages[value] for value in values], dtype=np.float64)
+
+    if weights.sum() <= 0:
+        raise ValueError("At least one trait value must have a positive rarity")
+    return weights / weights.sum()
+
+
+def exact_counts(probabilities: np.ndarray, total: int) -> np.ndarray:
+    """Split `total` into integer counts that follow `probabilities` (largest remainder)"""
+    raw = probabilities * total
+    counts = np.floor(raw).astype(np.int64)
+    short = total - int(counts.sum())
+    order = np.argsort(counts - raw, kind="stable")[:short]
+    counts[order] += 1
+    return counts
+
+
+class AliasTable:
+    """Walker/Vose alias table for O(1) draws from a discrete distribution.
+
+    A draw needs a single uniform u: its integer part picks a column of the
+    table and its fractional part decides between that column and its alias.
+    For a uniform distribution this reduces to floor(u * n).
+    """
+
+    def __init__(self, probabilities: np.ndarray):
+        n = len(probabilities)
+        scaled = np.asarray(probabilities, dtype=np.float64) * n
+        self.prob = np.ones(n, dtype=np.float64)
+        self.alias = np.arange(n, dtype=np.int64)
+        self.size = n
+
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left is 1.0 up to rounding error and keeps prob 1
+
+    def lookup(self, uniforms: np.ndarray) -> np.ndarray:
+        """Map uniforms in [0, 1) to drawn indices"""
+        scaled = uniforms * self.size
+        column = np.minimum(scaled.astype(np.int64), self.size - 1)
+        return np.where(scaled - column < self.prob[column], column, self.alias[column])
+
+
+class CombinationIndex:
+    """Set of trait combinations encoded as mixed-radix integers.
+
+    Each combination of column codes maps to one integer key in
+    [0, prod(radices)), with the first column as the most significant digit.
+    """
+
+    def __init__(self, radices: List[int]):
+        self.radices = list(radices)
+        self.space = 1
+        for radix in self.radices:
+            self.space *= radix
+        if self.space >= 1 << 63:
+            raise ValueError(f"Combination space of {self.space} does not fit in 64-bit keys")
+
+        # Keys are spread over the full space, but zero-weight values can
+        # never be drawn, so the sampler may lower the usable capacity
+        self.capacity = self.space
+        self.count = 0
+        if self.space <= BITSET_MAX_KEYS:
+            self._bits = np.zeros((self.space + 7) // 8, dtype=np.uint8)
+        else:
+            self._bits = None
+            self._sorted = np.empty(0, dtype=np.int64)
+            self._recent = set()
+
+    @property
+    def remaining(self) -> int:
+        return self.capacity - self.count
+
+    def encode(self, columns: List[np.ndarray]) -> np.ndarray:
+        """Encode parallel code columns into combination keys"""
+        keys = np.zeros(len(columns[0]), dtype=np.int64)
+        for radix, column in zip(self.radices, columns):
+            keys = keys * radix + column
+        return keys
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        """Vectorized membership test"""
+        if self._bits is not None:
+            return (self._bits[keys >> 3] >> (keys & 7).astype(np.uint8)) & 1 == 1
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self._sorted):
+            pos = np.minimum(np.searchsorted(self._sorted, keys), len(self._sorted) - 1)
+            found = self._sorted[pos] == keys
+        if self._recent:
+            found |= np.fromiter((int(k) in self._recent for k in keys), dtype=bool, count=len(keys))
+        return found
+
+    def __contains__(self, key: int) -> bool:
+        return bool(self.contains(np.array([key], dtype=np.int64))[0])
+
+    def add(self, keys: np.ndarray) -> None:
+        """Add keys that are known not to be in the index yet"""
+        self.count += len(keys)
+        if self._bits is not None:
+            np.bitwise_or.at(self._bits, keys >> 3, (1 << (keys & 7)).astype(np.uint8))
+        elif len(keys) == 1:
+            self._recent.add(int(keys[0]))
+        else:
+            merged = [self._sorted, keys]
+            if self._recent:
+                merged.append(np.fromiter(self._recent, dtype=np.int64))
+                self._recent = set()
+            self._sorted = np.sort(np.concatenate(merged))
+
+
+class TraitSampler:
+    """Draws whole trait columns as NumPy integer arrays.
+
+    Every token reads one row of uniforms: one per trait column, one for the
+    description template and one per RPG stat. Rows come from a counter-based
+    Philox stream keyed on the collection seed, with token N's row at a fixed
+    counter offset, so a token's traits depend only on (seed, token_id). Any
+    token range can be drawn on its own and gives the same values however
+    the range is split, and `draw` matches `sample` token for token.
+    """
+
+    TEMPLATE = "Template"
+
+    def __init__(self, columns: Dict[str, List[str]], stat_ranges: Dict[str, Tuple[int, int]],
+                 template_count: int, seed: int = None, unique: bool = False,
+                 rarity: Dict[str, Dict[str, float]] = None,
+                 joint_quotas: Dict[Tuple[str, str], Dict[Tuple[str, str], float]] = None,
+                 rules: List[Dict] = None):
+        # Rules may add an omitted value to some columns, so callers should
+        # read the vocabularies back from self.columns
+        vocabularies = columns
+        self.forbidden = {}
+        if rules:
+            columns, self.forbidden = compile_rules(columns, rules)
+        self.columns = columns
+        self.stat_ranges = stat_ranges
+        self.template_count = template_count
+        self.width = len(columns) + 1 + len(stat_ranges)
+        # Philox yields four 64-bit words per counter step; rows are padded
+        # to whole steps so each token starts on its own counter value
+        self.row_blocks = -(-self.width // 4)
+
+        # Alias tables are built once here; every draw is then O(1). Rarity
+        # covers the configured values only: an omitted value added by the
+        # rules is not a rarity tier (see _omitted_share)
+        rarity = rarity or {}
+        unknown = set(rarity) - set(columns)
+        if unknown:
+            raise ValueError(f"Rarity given for unknown trait types: {sorted(unknown)}")
+        self.probabilities = {
+            trait_type: trait_probabilities(values, rarity.get(trait_type))
+            for trait_type, values in vocabularies.items()
+        }
+        self.synthetic = {
+            trait_type: np.arange(len(values)) >= len(vocabularies[trait_type])
+            for trait_type, values in columns.items()
+        }
+        for trait_type, synthetic in self.synthetic.items():
+            if synthetic.any():
+                share = self._omitted_share(trait_type, rules)
+                self.probabilities[trait_type] = np.append(self.probabilities[trait_type] * (1 - share), share)
+        self.tables = {
+            trait_type: AliasTable(probabilities)
+            for trait_type, probabilities in self.probabilities.items()
+        }
+        self._masked_tables = {}
+
+        # Counting the valid combinations also proves up front that no
+        # sequence of draws can run out of allowed values
+        self.combinations = count_combinations(
+            self.columns, self.forbidden,
+            {trait_type: (probabilities > 0) | self.synthetic[trait_type]
+             for trait_type, probabilities in self.probabilities.items()}
+        )
+
+        # Joint quotas are stored as code pairs; each trait may appear in at
+        # most one pair of columns so the pairs can be allocated independently
+        self.joint_quotas = {}
+        for (first, second), targets in (joint_quotas or {}).items():
+            for trait_type in (first, second):
+                if trait_type not in columns:
+                    raise ValueError(f"Joint quota given for unknown trait type: {trait_type}")
+                if any(trait_type in pair for pair in self.joint_quotas):
+                    raise ValueError(f"{trait_type} appears in more than one joint quota")
+            self.joint_quotas[(first, second)] = {
+                (columns[first].index(a), columns[second].index(b)): percentage
+                for (a, b), percentage in targets.items()
+            }
+
+        # Unseeded samplers still follow the global `random` state, so
+        # random.seed() keeps working for callers that relied on it
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.seed = seed
+        main_seed, retry_seed, quota_seed = np.random.SeedSequence(seed).spawn(3)
+        self.key = main_seed.generate_state(2, np.uint64)
+        self.quota_key = quota_seed.generate_state(2, np.uint64)
+
+        # In unique mode duplicates are redrawn from a separate per-token
+        # stream, keeping the main rows independent of collisions
+        self.index = None
+        if unique:
+            self.index = CombinationIndex([len(values) for values in columns.values()])
+            self.index.capacity = self.combinations
+            self.retry_key = retry_seed.generate_state(2, np.uint64)
+
+    def _omitted_share(self, trait_type: str, rules: List[Dict]) -> float:
+        """Unmasked probability of a trait's omitted value.
+
+        An omit rule whose condition trait is drawn earlier forces the value
+        through the masks, so it needs no share of its own. One whose
+        condition is drawn later can only fire if the omitted value was
+        drawn first, so the value takes the condition's probability, and
+        the condition keeps its configured rarity.
+        """
+        order = list(self.columns)
+        kept = 1.0
+        for rule in rules:
+            (condition, values), = rule["if"].items()
+            if trait_type in rule.get("omit", []) and order.index(condition) > order.index(trait_type):
+                codes = [code for code in (self.columns[condition].index(value) for value in values)
+                         if code < len(self.probabilities[condition])]
+                kept *= 1 - self.probabilities[condition][codes].sum()
+        return 1 - kept
+
+    def _decode(self, uniforms: np.ndarray) -> Dict[str, np.ndarray]:
+        """Map a (count, width) block of uniforms to trait codes and stat values"""
+        codes = self._decode_traits(uniforms)
+
+        j = len(self.columns)
+        codes[self.TEMPLATE] = self._scale(uniforms[:, j], self.template_count)
+
+        for j, (stat_name, (low, high)) in enumerate(self.stat_ranges.items(), start=j + 1):
+            codes[stat_name] = low + self._scale(uniforms[:, j], high - low + 1)
+
+        return codes
+
+    def _decode_traits(self, uniforms: np.ndarray) -> Dict[str, np.ndarray]:
+        """Draw trait codes column by column, only from values the rules allow"""
+        codes = {}
+        for j, trait_type in enumerate(self.columns):
+            allowed = None
+            for earlier in codes:
+                matrix = self.forbidden.get((earlier, trait_type))
+                if matrix is not None:
+                    permitted = ~matrix[codes[earlier]]
+                    allowed = permitted if allowed is None else allowed & permitted
+            if allowed is None:
+                codes[trait_type] = self.tables[trait_type].lookup(uniforms[:, j])
+            else:
+                codes[trait_type] = self._masked_lookup(trait_type, allowed, uniforms[:, j])
+        return codes
+
+    def _masked_lookup(self, trait_type: str, allowed: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+        """Draw from per-row allowed-value masks, one alias table per distinct mask"""
+        packed = np.packbits(allowed, axis=1)
+        if packed.shape[1] <= 8:
+            # Masks of up to 64 values group much faster as single integers
+            padded = np.zeros((len(packed), 8), dtype=np.uint8)
+            padded[:, :packed.shape[1]] = packed
+            _, first, inverse = np.unique(padded.view(np.uint64).ravel(), return_index=True,
+                                          return_inverse=True)
+            masks = packed[first]
+        else:
+            masks, inverse = np.unique(packed, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(masks)))])
+
+        codes = np.empty(len(uniforms), dtype=np.int64)
+        for m, packed in enumerate(masks):
+            rows = order[bounds[m]:bounds[m + 1]]
+            codes[rows] = self._masked_table(trait_type, packed).lookup(uniforms[rows])
+        return codes
+
+    def _masked_table(self, trait_type: str, packed: np.ndarray) -> AliasTable:
+        key = (trait_type, packed.tobytes())
+        if key not in self._masked_tables:
+            size = len(self.columns[trait_type])
+            mask = np.unpackbits(packed)[:size].astype(bool)
+            probabilities = self.probabilities[trait_type] * mask
+            if probabilities.sum() == 0:
+                # Only an omitted value is left, e.g. hair color for a base that has none
+                probabilities = (mask & self.synthetic[trait_type]).astype(np.float64)
+            self._masked_tables[key] = AliasTable(probabilities / probabilities.sum())
+        return self._masked_tables[key]
+
+    @staticmethod
+    def _scale(column: np.ndarray, size: int) -> np.ndarray:
+        # Clamp guards against u * size rounding up to size for u close to 1
+        return np.minimum((column * size).astype(np.int64), size - 1)
+
+    def _uniforms(self, start_id: int, count: int) -> np.ndarray:
+        """Read the uniform rows of tokens [start_id, start_id + count)"""
+        bit_generator = np.random.Philox(key=self.key)
+        bit_generator.advance(start_id * self.row_blocks)
+        rows = np.random.Generator(bit_generator).random((count, self.row_blocks * 4))
+        return rows[:, :self.width]
+
+    def draw(self, token_id: int) -> Dict[str, int]:
+        """Draw the codes for a single token"""
+        if self.index is not None:
+            self._check_capacity(1)
+        codes = self._decode(self._uniforms(token_id, 1))
+        if self.index is not None:
+            key = int(self.index.encode([codes[name] for name in self.columns])[0])
+            if key in self.index:
+                key = self._redraw(token_id, lambda k: k in self.index)
+                self._set_trait_codes(codes, 0, key)
+            self.index.add(np.array([key], dtype=np.int64))
+        return {name: int(column[0]) for name, column in codes.items()}
+
+    def sample(self, start_id: int, count: int) -> Dict[str, np.ndarray]:
+        """Draw the codes for tokens [start_id, start_id + count) as one array per column"""
+        if self.index is not None:
+            self._check_capacity(count)
+        codes = self._decode(self._uniforms(start_id, count))
+        if self.index is not None and count:
+            self._deduplicate(start_id, codes)
+        return codes
+
+    def allocate(self, start_id: int, count: int) -> Dict[str, np.ndarray]:
+        """Draw tokens [start_id, start_id + count) with exact trait quotas.
+
+        Instead of drawing every token independently, each trait column is
+        filled with exactly round(probability * count) copies of every value
+        and shuffled in place, so the batch hits the configured distribution
+        exactly. Template and stats are drawn per token as in `sample`.
+        """
+        if self.index is not None:
+            raise ValueError("Quota allocation cannot be combined with unique mode")
+        if self.forbidden:
+            raise ValueError("Quota allocation cannot be combined with trait rules")
+
+        codes = self._decode(self._uniforms(start_id, count))
+        rng = np.random.Generator(np.random.Philox(key=self.quota_key, counter=[0, start_id, count, 0]))
+        quotas = {trait_type: exact_counts(self.probabilities[trait_type], count)
+                  for trait_type in self.columns}
+
+        for (first, second), targets in self.joint_quotas.items():
+            codes[first], codes[second] = self._allocate_pair(
+                first, second, targets, quotas[first], quotas[second], count, rng
+            )
+
+        paired = {trait_type for pair in self.joint_quotas for trait_type in pair}
+        for trait_type in self.columns:
+            if trait_type not in paired:
+                column = np.repeat(np.arange(len(quotas[trait_type])), quotas[trait_type])
+                rng.shuffle(column)
+                codes[trait_type] = column
+        return codes
+
+    def _allocate_pair(self, first: str, second: str, targets: Dict[Tuple[int, int], float],
+                       first_quota: np.ndarray, second_quota: np.ndarray, count: int,
+                       rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+        """Fill two columns so each targeted value pair occurs an exact number of times"""
+        first_quota, second_quota = first_quota.copy(), second_quota.copy()
+        targeted = np.zeros((len(first_quota), len(second_quota)), dtype=bool)
+        fixed_first, fixed_second = [], []
+        for (a, b), percentage in targets.items():
+            pair_count = int(round(percentage * count / 100))
+            if pair_count > first_quota[a] or pair_count > second_quota[b]:
+                raise ValueError(
+                    f"Joint quota of {percentage}% for {self.columns[first][a]} x "
+                    f"{self.columns[second][b]} exceeds the quota of one of its values"
+                )
+            first_quota[a] -= pair_count
+            second_quota[b] -= pair_count
+            fixed_first.append(np.full(pair_count, a, dtype=np.int64))
+            fixed_second.append(np.full(pair_count, b, dtype=np.int64))
+            targeted[a, b] = True
+
+        free_first = np.repeat(np.arange(len(first_quota)), first_quota)
+        free_second = np.repeat(np.arange(len(second_quota)), second_quota)
+        rng.shuffle(free_first)
+        rng.shuffle(free_second)
+
+        # Free rows that landed on a targeted pair swap their second value
+        # with a row where neither side ends up on a targeted pair
+        window = 4096
+        for row in np.flatnonzero(targeted[free_first, free_second]):
+            if not targeted[free_first[row], free_second[row]]:
+                continue
+            offset = int(rng.integers(len(free_first)))
+            for chunk in range(offset, offset + len(free_first), window):
+                candidates = np.arange(chunk, min(chunk + window, offset + len(free_first))) % len(free_first)
+                allowed = (~targeted[free_first[row], free_second[candidates]]
+                           & ~targeted[free_first[candidates], free_second[row]])
+                if allowed.any():
+                    other = candidates[np.argmax(allowed)]
+                    free_second[row], free_second[other] = free_second[other], free_second[row]
+                    break
+            else:
+                raise ValueError(f"Cannot meet the joint quotas for {first} x {second} exactly")
+
+        first_column = np.concatenate(fixed_first + [free_first])
+        second_column = np.concatenate(fixed_second + [free_second])
+        order = rng.permutation(count)
+        return first_column[order], second_column[order]
+
+    def _check_capacity(self, count: int) -> None:
+        if count > self.index.remaining:
+            raise ValueError(
+                f"Cannot generate {count} unique tokens: only {self.index.remaining} of "
+                f"{self.index.capacity} trait combinations are still available"
+            )
+
+    def _set_trait_codes(self, codes: Dict[str, np.ndarray], row: int, key: int) -> None:
+        for name, radix in reversed(list(zip(self.columns, self.index.radices))):
+            key, codes[name][row] = divmod(key, radix)
+
+    def _redraw(self, token_id: int, taken: Callable[[int], bool]) -> int:
+        """Draw trait combinations from the token's retry stream until one is free"""
+        bit_generator = np.random.Philox(key=self.retry_key, counter=[0, token_id, 0, 0])
+        rng = np.random.Generator(bit_generator)
+        while True:
+            codes = self._decode_traits(rng.random((1, len(self.columns))))
+            key = int(self.index.encode([codes[trait_type] for trait_type in self.columns])[0])
+            if not taken(key):
+                return key
+
+    def _deduplicate(self, start_id: int, codes: Dict[str, np.ndarray]) -> None:
+        """Redraw duplicate rows in token order, exactly as repeated draw() calls would"""
+        keys = self.index.encode([codes[name] for name in self.columns])
+        _, first = np.unique(keys, return_index=True)
+        clean = np.zeros(len(keys), dtype=bool)
+        clean[first] = True
+        clean &= ~self.index.contains(keys)
+
+        pending = np.flatnonzero(~clean).tolist()
+        if not pending:
+            self.index.add(keys)
+            return
+
+        # Clean rows keep their key unless an earlier redraw claims it first
+        clean_rows = np.flatnonzero(clean)
+        owner = dict(zip(keys[clean_rows].tolist(), clean_rows.tolist()))
+        heapq.heapify(pending)
+        claimed = set()
+
+        while pending:
+            row = heapq.heappop(pending)
+
+            def taken(key: int) -> bool:
+                if key in claimed:
+                    return True
+                if key in owner:
+                    return owner[key] < row
+                return key in self.index
+
+            key = self._redraw(start_id + row, taken)
+            later = owner.pop(key, None)
+            if later is not None:
+                heapq.heappush(pending, later)
+            claimed.add(key)
+            keys[row] = key
+            self._set_trait_codes(codes, row, key)
+
+        self.index.add(keys)
+